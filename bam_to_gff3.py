@@ -3,10 +3,90 @@
 # Author: Matt Douglas
 
 from __future__ import print_function
+import argparse
+import heapq
+import numpy as np
 import os
 import pysam
-import sys
 from collections import defaultdict
+from cigar import parse_CIGAR
+from gff3 import Feature, bgzip_gff3, write_gff3
+from metrics import Metrics
+from profiling import Profiler
+
+SCAN_SIZE = 1 << 24 # number of bases scanned at once for coverage changes
+
+metrics = Metrics() # timings and counts for each stage, written with --metrics
+profiler = Profiler() # CPU, memory and per-read profiles, written with --profile
+
+class Coverage(object):
+    """Per-base coverage of the exon blocks, kept as a difference array for each
+    chromosome. Block boundaries are buffered and added to the array in
+    batches. If the input is sorted, each chromosome is written as soon as the
+    next one starts, so only one array is held in memory at a time.
+
+    Attributes:
+        samfile: The input file (used for chromosome names and lengths).
+        outfile: An open bedGraph file to write to.
+        streaming: True if chromosomes can be written as soon as they're done.
+        diffs: The difference array (int32) of each chromosome.
+        starts: Buffered start positions (0-based) of blocks on each chromosome.
+        ends: Buffered end positions (0-based, exclusive) of blocks.
+        chrom: The last chromosome added to.
+    """
+
+    def __init__(self, samfile, outfile, streaming=False):
+        self.samfile = samfile
+        self.outfile = outfile
+        self.streaming = streaming
+        self.diffs = {}
+        self.starts = defaultdict(list)
+        self.ends = defaultdict(list)
+        self.chrom = None
+
+    def add(self, chrom, exons):
+        """Add the exon blocks of one alignment."""
+        if chrom != self.chrom:
+            if self.streaming and self.chrom is not None:
+                self.write(self.chrom)
+            self.chrom = chrom
+        starts, ends = self.starts[chrom], self.ends[chrom]
+        for _, start, end, _ in exons:
+            starts.append(start - 1)
+            ends.append(end)
+        if len(starts) >= 1000000:
+            self.apply(chrom)
+
+    def apply(self, chrom):
+        """Add the buffered blocks on a chromosome to its difference array."""
+        if chrom not in self.diffs:
+            self.diffs[chrom] = np.zeros(self.samfile.get_reference_length(chrom) + 1, dtype=np.int32)
+        diff = self.diffs[chrom]
+        np.add.at(diff, np.array(self.starts.pop(chrom, []), dtype=np.int64), 1)
+        np.add.at(diff, np.array(self.ends.pop(chrom, []), dtype=np.int64), -1)
+
+    def write(self, chrom):
+        """Write the coverage of a chromosome as run-length encoded bedGraph
+        lines (0-based, half-open), skipping uncovered runs, and free it. Only
+        the positions where the coverage changes are expanded, a SCAN_SIZE
+        window at a time, so no other array the length of the chromosome is
+        made.
+        """
+        self.apply(chrom)
+        diff = self.diffs.pop(chrom)
+        changes = np.concatenate([np.flatnonzero(diff[i:i+SCAN_SIZE]) + i for i in range(0, len(diff), SCAN_SIZE)])
+        depth = np.cumsum(diff[changes], dtype=np.int64)
+        for start, end, value in zip(changes[:-1].tolist(), changes[1:].tolist(), depth[:-1].tolist()):
+            if value != 0:
+                print(chrom, start, end, value, sep='\t', file=self.outfile)
+
+    def close(self):
+        """Write every remaining chromosome, in the order of the header."""
+        remaining = set(self.diffs) | set(self.starts)
+        for chrom in self.samfile.references:
+            if chrom in remaining:
+                self.write(chrom)
+
 
 def optype(path, op='r'):
     """If the file is BAM formatted, read/write as binary."""
@@ -23,51 +103,88 @@ def get_strand(line):
         return '+'
 
 
-def parse_CIGAR(cigar):
-    """Parse a pysam formatted CIGAR string return positions of each skip."""
-    ref_pos = 0
-    str_pos = 0
-    ref_pos_list = [0]
-    length_list = []
-
-    cigar_type = [i[0] for i in cigar]
-    cigar_len  = [i[1] for i in cigar]
-
-    length = 0
-    for n, i in enumerate(cigar_type):
-        j = cigar_len[n]
-        if i == 0: # match
-            ref_pos += j
-            length += j
-        elif i == 2: # deletion
-            ref_pos += j
-            length += j
-        elif i == 3: # skip
-            ref_pos += j
-            ref_pos_list.append(ref_pos)
-            length_list.append(length)
-            length = 0
-        elif i == 4: # soft clipping
-            length += j
-    ref_pos_list.append(ref_pos)
-    length_list.append(length)
-
-    return ref_pos_list, length_list
-
-
-def convert_alignment_to_tuple(samfile):
-    for line in samfile.fetch():
+def iter_alignments(samfile):
+    """Iterate over the alignments in file order, using the index if there is
+    one.
+    """
+    if samfile.has_index():
+        return samfile.fetch()
+    return samfile.fetch(until_eof=True)
+
+
+def is_sorted(samfile):
+    """Return True if the file is (or claims to be) coordinate-sorted."""
+    if samfile.has_index():
+        return True
+    return samfile.header.to_dict().get('HD', {}).get('SO') == 'coordinate'
+
+
+def convert_alignments(samfile, coverage=None):
+    """Yield the chromosome, position and list of exon blocks of each mapped
+    alignment. If given, the blocks are also added to 'coverage'.
+    """
+    reads = 0
+    for line in profiler.sample('convert_alignment_to_tuple', iter_alignments(samfile)):
+        reads += 1
+        if line.is_unmapped:
+            continue
         chrom = samfile.get_reference_name(line.reference_id)
         pos = line.pos + 1 # SAM coordinates are 1-based
-        seq = line.query_sequence
-        qual = line.query_qualities
         cigar = line.cigartuples
         strand = get_strand(line)
-        ref_pos_list, length_list = parse_CIGAR(cigar)
-        for i in range(len(ref_pos_list)-1):
-            start = pos + ref_pos_list[i]
-            end = start + length_list[i] - 1
-            yield chrom, start, end, strand
+        exons = [(chrom, start, end, strand) for start, end in parse_CIGAR(pos, cigar)[1]]
+        if coverage is not None:
+            coverage.add(chrom, exons)
+        yield chrom, pos, exons
+    metrics.count(reads=reads)
+
+
+def convert_alignment_to_tuple(samfile, coverage=None):
+    for chrom, pos, exons in convert_alignments(samfile, coverage):
+        for exon in exons:
+            yield exon
+
+
+def count_exons(samfile, coverage=None):
+    """Count the reads supporting each exon in a coordinate-sorted file, and
+    yield each (exon, count) in order as soon as it is complete. Reads never
+    start before the previous read, so an exon starting before the current read
+    can't gain any more support. Only exons that may still be extended are kept
+    in memory.
+    """
+    counts = {}
+    pending = [] # heap of exons that are still being counted
+    prev_chrom, prev_pos = None, 0
+    seen_chroms = set()
+
+    for chrom, pos, exons in convert_alignments(samfile, coverage):
+        if chrom != prev_chrom:
+            if chrom in seen_chroms:
+                raise ValueError('Input is not sorted by coordinate ({} appears twice)'.format(chrom))
+            seen_chroms.add(chrom)
+            # every exon on the previous chromosome is complete
+            while len(pending) > 0:
+                exon = heapq.heappop(pending)
+                yield exon, counts.pop(exon)
+        elif pos < prev_pos:
+            raise ValueError('Input is not sorted by coordinate ({}:{} after {}:{})'.format(chrom, pos, chrom, prev_pos))
+        prev_chrom, prev_pos = chrom, pos
+
+        # exons starting before this read are complete
+        while len(pending) > 0 and pending[0][1] < pos:
+            exon = heapq.heappop(pending)
+            yield exon, counts.pop(exon)
+
+        for exon in exons:
+            if exon in counts:
+                counts[exon] += 1
+            else:
+                counts[exon] = 1
+                heapq.heappush(pending, exon)
+
+    while len(pending) > 0:
+        exon = heapq.heappop(pending)
+        yield exon, counts.pop(exon)
 
 
 def sort_by_pos(exons):
@@ -81,26 +198,72 @@ def sort_by_pos(exons):
         return sorted(exons, key=lambda x: (x[0], int(x[1]), int(x[2])))
 
 
-def print_as_gff3(count_dict, outfile):
-    sorted_feats = sort_by_pos(count_dict.keys())
-
+def print_as_gff3(features, outfile):
+    """Write (exon, count) pairs to a GFF3 file, in the order given."""
     with open(outfile, 'w') as f:
-        print('#gff3-version 3', file=f)
-        for feature in sorted_feats:
-            chrom, start, end, strand = feature
-            count = count_dict[feature]
-            line = chrom, '.', 'exon', start, end, count, strand, '.', '.'
-            print(*line, sep='\t', file=f)
+        return write_gff3((Feature(chrom, '.', 'exon', start, end, count, strand)
+                    for (chrom, start, end, strand), count in features), f)
 
 
-if __name__ == '__main__':
-    count_dict = defaultdict(int)
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Count the reads supporting each exon block in a SAM/BAM file.')
+    parser.add_argument('infile',
+                        type=str,
+                        help='a SAM or BAM file')
+    parser.add_argument('outfile',
+                        type=str,
+                        help='output GFF3 file')
+    parser.add_argument('-c',
+                        '--coverage',
+                        type=str,
+                        help='(optional) also write the per-base coverage of the exon blocks to this bedGraph file')
+    parser.add_argument('-z',
+                        '--bgzip',
+                        action='store_true',
+                        help="(optional) compress the output with bgzip and index it with tabix ('<outfile>.gz' and '<outfile>.gz.tbi')")
+    parser.add_argument('--metrics',
+                        type=str,
+                        metavar='FILE',
+                        help='(optional) write the time, reads decoded, features emitted and peak memory of each stage to FILE as JSON')
+    parser.add_argument('--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='(optional) profile the main process and write a CPU profile, the top memory allocations and a sampled time-per-read histogram to DIR')
+    args = parser.parse_args()
+
+    return args.infile, args.outfile, args.coverage, args.bgzip, args.metrics, args.profile
 
-    infile = sys.argv[1]
-    outfile = sys.argv[2]
+
+if __name__ == '__main__':
+    infile, outfile, coverage_path, bgzip, metrics.path, profile_dir = parse_commandline_arguments()
+    profiler.start(profile_dir)
     samfile = pysam.AlignmentFile(infile, optype(infile, 'r'))
+    streaming = is_sorted(samfile)
 
-    for feature in convert_alignment_to_tuple(samfile):
-        count_dict[feature] += 1
+    coverage = None
+    if coverage_path is not None:
+        coverage_file = open(coverage_path, 'w')
+        coverage = Coverage(samfile, coverage_file, streaming)
+
+    if streaming:
+        # stream the exons to the output in the order they appear in the file
+        with metrics.stage('scan BAM and write'):
+            metrics.count(features=print_as_gff3(count_exons(samfile, coverage), outfile))
+    else:
+        with metrics.stage('scan BAM'):
+            count_dict = defaultdict(int)
+            for feature in convert_alignment_to_tuple(samfile, coverage):
+                count_dict[feature] += 1
+        with metrics.stage('sort and write'):
+            features = ((i, count_dict[i]) for i in sort_by_pos(count_dict))
+            metrics.count(features=print_as_gff3(features, outfile))
+    if bgzip:
+        with metrics.stage('compress'):
+            bgzip_gff3(outfile)
 
-    print_as_gff3(count_dict, outfile)
+    if coverage is not None:
+        with metrics.stage('write coverage'):
+            coverage.close()
+            coverage_file.close()
+    profiler.stop()
+    metrics.write()
@@ -0,0 +1,484 @@
+#!/usr/local/bin/python3
+# Purpose: Time the BAM and GFF3 hot paths of the scripts on synthetic data.
+#          Generates a coordinate-sorted BAM file of spliced alignments (with a
+#          short- or long-read profile) and two large, partly overlapping GFF3
+#          files, then times each scenario and writes the results as JSON. Each
+#          run of a scenario is in a fresh process, so its peak memory is its
+#          own. A previous result file can be given as a baseline to compare
+#          against.
+# USAGE:   benchmark.py --read-profile short -o results.json [--baseline old.json]
+
+from __future__ import print_function, division
+import argparse, array, json, multiprocessing, os, platform, random, shutil, sys, tempfile
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from time import time
+import pysam
+
+import bam_to_gff3
+import diff_gff3
+import generate_intron_gff3
+import nonredundant_gff3
+import reads_supporting_introns
+import split_alignments
+from metrics import cpu_time, peak_rss_mb
+from profiling import Profiler
+
+# default settings for each read profile
+PROFILES = {
+    'short': {'reads': 200000, 'read_length': 100, 'junctions': 1, 'indel_rate': 0.0, 'features': 500000},
+    'long': {'reads': 20000, 'read_length': 5000, 'junctions': 8, 'indel_rate': 0.01, 'features': 500000},
+}
+CHROMS = ('I', 'II', 'III', 'IV', 'V', 'X') # reference sequence names
+CHROM_LENGTH = 10000000 # length of each reference sequence
+TRANSCRIPTS = 2000 # maximum number of transcripts on each reference the reads are drawn from
+INTRON_LENGTHS = (50, 60, 100, 200, 500, 1000, 5000) # intron lengths of the transcripts
+INTRONS_SEARCHED = 1000 # number of introns searched for by reads_supporting_introns.py
+SHARED_FEATURES = 0.5 # fraction of the features in the first GFF3 file that are also in the second
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Time the BAM and GFF3 hot paths on synthetic data.')
+    parser.add_argument('--read-profile',
+                        type=str,
+                        choices=sorted(PROFILES),
+                        default='short',
+                        help="read profile to generate (default='short')")
+    parser.add_argument('-n',
+                        '--reads',
+                        type=int,
+                        help='number of alignments (default: set by the profile)')
+    parser.add_argument('-l',
+                        '--read-length',
+                        type=int,
+                        help='aligned read length (default: set by the profile)')
+    parser.add_argument('-j',
+                        '--junctions',
+                        type=float,
+                        help='average number of junctions per read (default: set by the profile)')
+    parser.add_argument('-f',
+                        '--features',
+                        type=int,
+                        help='number of features in each GFF3 file (default: set by the profile)')
+    parser.add_argument('-s',
+                        '--scenarios',
+                        type=str,
+                        nargs='+',
+                        help='only run these scenarios (default: all of them)')
+    parser.add_argument('-r',
+                        '--repeat',
+                        type=int,
+                        default=3,
+                        help='number of times to run each scenario; the fastest run is reported (default=3)')
+    parser.add_argument('--seed',
+                        type=int,
+                        default=1,
+                        help='random seed for the synthetic data (default=1)')
+    parser.add_argument('-d',
+                        '--data-dir',
+                        type=str,
+                        help='keep the synthetic data in this directory, and reuse it in later runs (default: a temporary directory)')
+    parser.add_argument('-o',
+                        '--output',
+                        type=str,
+                        help='write the results to this JSON file (default: stdout)')
+    parser.add_argument('-b',
+                        '--baseline',
+                        type=str,
+                        help='a previous results file to compare against')
+    parser.add_argument('-p',
+                        '--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='profile the last run of each scenario and write a CPU profile, the top memory allocations and a sampled time-per-read histogram to DIR/<scenario>')
+    parser.add_argument('-v',
+                        '--verbose',
+                        action='store_true',
+                        help="show the scripts' own progress messages")
+    args = parser.parse_args()
+
+    settings = dict(PROFILES[args.read_profile])
+    for key in ('reads', 'read_length', 'junctions', 'features'):
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    settings['profile'] = args.read_profile
+    settings['seed'] = args.seed
+
+    if args.scenarios is not None:
+        for name in args.scenarios:
+            if name not in SCENARIOS:
+                print("Unknown scenario '{}'! Choose from: {}".format(name, ', '.join(SCENARIOS)))
+                sys.exit(1)
+
+    return args, settings
+
+
+def eprint(*args, **kwargs):
+    """Print to stderr."""
+    print(*args, file=sys.stderr, **kwargs)
+
+
+@contextmanager
+def quiet(verbose=False):
+    """Silence stderr (the scripts' progress messages) unless 'verbose'."""
+    if verbose:
+        yield
+        return
+    stderr = sys.stderr
+    with open(os.devnull, 'w') as devnull:
+        sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stderr = stderr
+
+
+##################
+# Synthetic data #
+##################
+def make_transcripts(rng, exon_length, read_length):
+    """Return a list of transcripts on each reference, where a transcript is a
+    list of (start, end) exons, 0-based and half-open. Exon lengths average
+    'exon_length' and each transcript is long enough to hold a few reads.
+    """
+    transcripts = {}
+    for chrom in CHROMS:
+        transcripts[chrom] = []
+        pos = rng.randrange(1000)
+        while len(transcripts[chrom]) < TRANSCRIPTS:
+            exons, exonic = [], 0
+            while exonic < 3 * read_length:
+                length = max(1, int(exon_length * rng.uniform(0.5, 1.5)))
+                exons.append((pos, pos + length))
+                exonic += length
+                pos += length + rng.choice(INTRON_LENGTHS)
+            if exons[-1][1] > CHROM_LENGTH:
+                break
+            transcripts[chrom].append(exons)
+            pos += rng.randrange(1000, 10000)
+
+    return transcripts
+
+
+def place_read(rng, exons, read_length, indel_rate):
+    """Place a read on a transcript and return its 0-based position and CIGAR
+    (as pysam tuples).
+    """
+    total = sum(end - start for start, end in exons)
+    offset = rng.randrange(total - read_length + 1)
+
+    cigar = []
+    remaining = read_length
+    pos = None
+    prev_end = None
+    for start, end in exons:
+        if offset >= end - start:
+            offset -= end - start
+            continue
+        block_start = start + offset
+        offset = 0
+        block = min(end - block_start, remaining)
+        if pos is None:
+            pos = block_start
+        else:
+            cigar.append((3, block_start - prev_end)) # N
+        # split the block with small insertions and deletions
+        done = 0
+        while block - done > 0:
+            step = block - done
+            if indel_rate > 0:
+                step = min(step, max(1, int(rng.expovariate(indel_rate))))
+            cigar.append((0, step)) # M
+            done += step
+            if done < block:
+                length = rng.randint(1, 3)
+                if rng.random() < 0.5 and done + length < block:
+                    cigar.append((2, length)) # D
+                    done += length
+                else:
+                    cigar.append((1, length)) # I
+        remaining -= block
+        prev_end = block_start + block
+        if remaining == 0:
+            break
+
+    return pos, cigar
+
+
+def generate_bam(path, reads, read_length, junctions, indel_rate=0.0, seed=1):
+    """Write a coordinate-sorted, indexed BAM file of synthetic spliced
+    alignments. Reads are drawn from a fixed set of transcripts, so introns are
+    supported by several reads, and consecutive reads share a name (like mates).
+    Returns the introns as (chromosome, start, end) tuples, 1-based.
+    """
+    rng = random.Random(seed)
+    transcripts = make_transcripts(rng, read_length / (junctions + 1), read_length)
+    bases = ''.join(rng.choice('ACGT') for _ in range(2 * read_length + 100000))
+
+    alignments = []
+    for _ in range(reads):
+        tid = rng.randrange(len(CHROMS))
+        pos, cigar = place_read(rng, rng.choice(transcripts[CHROMS[tid]]), read_length, indel_rate)
+        alignments.append((tid, pos, cigar))
+    alignments.sort(key=lambda x: (x[0], x[1]))
+
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': i, 'LN': CHROM_LENGTH} for i in CHROMS]}
+    with pysam.AlignmentFile(path, 'wb', header=header) as outfile:
+        for n, (tid, pos, cigar) in enumerate(alignments):
+            qlen = sum(length for op, length in cigar if op in (0, 1))
+            start = rng.randrange(len(bases) - qlen)
+            line = pysam.AlignedSegment(outfile.header)
+            line.query_name = 'read{}'.format(n // 2)
+            line.flag = 16 if n % 3 == 0 else 0
+            line.reference_id = tid
+            line.reference_start = pos
+            line.mapping_quality = 60
+            line.cigartuples = cigar
+            line.query_sequence = bases[start:start+qlen]
+            line.query_qualities = array.array('B', [40]) * qlen
+            line.set_tag('XS', '-' if n % 3 == 0 else '+')
+            outfile.write(line)
+    pysam.index(path)
+
+    introns = set()
+    for chrom in CHROMS:
+        for exons in transcripts[chrom]:
+            for (_, end), (start, _) in zip(exons, exons[1:]):
+                introns.add((chrom, end + 1, start))
+    return sorted(introns)
+
+
+def generate_gff3(path, features, seed=1, shared_path=None):
+    """Write a GFF3 file of synthetic exons and introns. If 'shared_path' is
+    given, a second file is also written that shares SHARED_FEATURES of the
+    positions of the first.
+    """
+    rng = random.Random(seed)
+    positions = []
+    for n in range(features):
+        start = rng.randrange(1, CHROM_LENGTH - 10000)
+        positions.append((rng.choice(CHROMS), rng.choice(('exon', 'intron')), start,
+                          start + rng.randint(50, 5000), rng.choice('+-')))
+
+    def write(path, positions):
+        with open(path, 'w') as f:
+            print('##gff-version 3', file=f)
+            for n, (chrom, ftype, start, end, strand) in enumerate(sorted(positions)):
+                print(chrom, 'benchmark', ftype, start, end, rng.randint(1, 100), strand, '.',
+                      'ID={}{};Name=feature{}'.format(ftype, n+1, n+1), sep='\t', file=f)
+
+    write(path, positions)
+    if shared_path is not None:
+        shared = int(features * SHARED_FEATURES)
+        others = [(c, t, s + 1, e + 1, st) for c, t, s, e, st in positions[shared:]]
+        write(shared_path, positions[:shared] + others)
+
+
+def prepare_data(data_dir, settings):
+    """Generate (or reuse) the synthetic files and return their paths and the
+    introns the reads were drawn from.
+    """
+    name = 'bench_{profile}_{reads}_{read_length}_{junctions}_{indel_rate}_{seed}'.format(**settings)
+    data = {'bam': os.path.join(data_dir, name + '.bam'),
+            'introns': os.path.join(data_dir, name + '.introns.json'),
+            'gff3': [os.path.join(data_dir, 'bench_{}_{}_{}.gff3'.format(settings['features'], settings['seed'], i))
+                     for i in (1, 2)]}
+
+    if not (os.path.exists(data['bam']) and os.path.exists(data['introns'])):
+        eprint('Generating {:,} alignments...'.format(settings['reads']))
+        introns = generate_bam(data['bam'], settings['reads'], settings['read_length'], settings['junctions'],
+                               settings['indel_rate'], settings['seed'])
+        with open(data['introns'], 'w') as f:
+            json.dump(introns, f)
+    with open(data['introns'], 'r') as f:
+        data['intron_list'] = [tuple(i) for i in json.load(f)]
+
+    if not all(os.path.exists(i) for i in data['gff3']):
+        eprint('Generating 2 GFF3 files of {:,} features...'.format(settings['features']))
+        generate_gff3(data['gff3'][0], settings['features'], settings['seed'], data['gff3'][1])
+
+    return data
+
+
+#############
+# Scenarios #
+#############
+# Each scenario takes the synthetic data and returns the number of reads
+# decoded and the number of features (or alignments) produced.
+def bench_find_introns(data):
+    with pysam.AlignmentFile(data['bam'], 'rb') as bamfile, generate_intron_gff3.metrics.stage('benchmark') as stage:
+        count_dict = generate_intron_gff3.find_introns(bamfile, defaultdict(int))
+    return stage['reads'], len(count_dict)
+
+
+def searched_introns(data):
+    rng = random.Random(0)
+    return rng.sample(data['intron_list'], min(INTRONS_SEARCHED, len(data['intron_list'])))
+
+
+def bench_find_supporting_alignments(data):
+    rsi = reads_supporting_introns
+    with pysam.AlignmentFile(data['bam'], 'rb') as samfile, rsi.metrics.stage('benchmark') as stage:
+        rsi.progress, rsi.quiet = rsi.Progress(samfile.mapped), False # set by the script itself
+        found = sum(1 for _ in rsi.find_supporting_alignments(samfile, searched_introns(data)))
+    return stage['reads'], found
+
+
+def bench_report_all_alignments(data):
+    rsi = reads_supporting_introns
+    with pysam.AlignmentFile(data['bam'], 'rb') as samfile, rsi.metrics.stage('benchmark') as stage:
+        rsi.progress, rsi.quiet = rsi.Progress(samfile.mapped), False # set by the script itself
+        matches = rsi.find_supporting_alignments(samfile, searched_introns(data))
+        found = sum(1 for _ in rsi.report_all_alignments(samfile, matches))
+    return stage['reads'], found
+
+
+def bench_convert_alignment_to_tuple(data):
+    with pysam.AlignmentFile(data['bam'], 'rb') as samfile, bam_to_gff3.metrics.stage('benchmark') as stage:
+        exons = sum(1 for _ in bam_to_gff3.convert_alignment_to_tuple(samfile))
+    return stage['reads'], exons
+
+
+def bench_split_alignments(data):
+    with pysam.AlignmentFile(data['bam'], 'rb') as infile:
+        reads, split = 0, 0
+        for line in infile.fetch(until_eof=True):
+            reads += 1
+            split += len(split_alignments.split_alignment(line))
+    return reads, split
+
+
+def bench_split_to_sorted_file(data):
+    out_dir = tempfile.mkdtemp(prefix='split_', dir=os.path.dirname(data['bam']))
+    try:
+        with pysam.AlignmentFile(data['bam'], 'rb') as infile, split_alignments.metrics.stage('benchmark') as stage:
+            writer = split_alignments.SortedWriter(os.path.join(out_dir, 'split.bam'), split_alignments.sorted_header(infile))
+            split_alignments.split_to_sorted_file(infile, writer)
+    finally:
+        shutil.rmtree(out_dir)
+    return stage['reads'], stage['features']
+
+
+def bench_nonredundant_parse_GFF3(data):
+    header, entries = nonredundant_gff3.parse_GFF3(data['gff3'])
+    return 0, sum(1 for _ in nonredundant_gff3.sort_features(entries)) # the entries are merged as they're read
+
+
+def bench_compare_features(data):
+    with open(os.devnull, 'w') as diff_gff3.log: # set by the script itself
+        unique, paired, common, matrix, best = diff_gff3.compare_features(data['gff3'])
+    return 0, sum(matrix.values())
+
+
+SCENARIOS = OrderedDict([
+    ('find_introns', bench_find_introns),
+    ('find_supporting_alignments', bench_find_supporting_alignments),
+    ('report_all_alignments', bench_report_all_alignments),
+    ('convert_alignment_to_tuple', bench_convert_alignment_to_tuple),
+    ('split_alignments', bench_split_alignments),
+    ('split_to_sorted_file', bench_split_to_sorted_file),
+    ('nonredundant_parse_GFF3', bench_nonredundant_parse_GFF3),
+    ('compare_features', bench_compare_features),
+])
+
+
+def time_scenario(task):
+    """Worker: run a scenario once and return its wall time, CPU time, counts
+    and the peak memory of the process.
+    """
+    name, data, profile_dir, verbose = task
+    # share one profiler between the scripts, so they can be profiled together
+    profiler = Profiler()
+    for module in (bam_to_gff3, diff_gff3, generate_intron_gff3, nonredundant_gff3, reads_supporting_introns, split_alignments):
+        module.profiler = profiler
+    profiler.start(profile_dir)
+    wall, cpu = time(), cpu_time()
+    with quiet(verbose):
+        reads, features = SCENARIOS[name](data)
+    wall, cpu = time() - wall, cpu_time() - cpu
+    profiler.stop()
+
+    return wall, cpu, reads, features, peak_rss_mb()
+
+
+def run_scenario(name, data, repeat, verbose=False, profile_dir=None):
+    """Run a scenario 'repeat' times, each in a fresh process, and return its
+    results, reporting the fastest run. The peak memory is the largest of the
+    processes running the scenario (including the interpreter and imports).
+    """
+    if profile_dir is not None:
+        profile_dir = os.path.join(profile_dir, name)
+    pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1)
+    try:
+        runs = pool.map(time_scenario, [(name, data, profile_dir, verbose)] * repeat, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    wall_times, cpu_times, reads, features, peak_rss = zip(*runs)
+
+    best = min(wall_times)
+    return {'name': name,
+            'wall_time': best,
+            'wall_times': list(wall_times),
+            'cpu_time': min(cpu_times),
+            'reads': reads[0],
+            'reads_per_second': reads[0] / best if reads[0] > 0 and best > 0 else None,
+            'features': features[0],
+            'features_per_second': features[0] / best if best > 0 else None,
+            'peak_rss_mb': max(peak_rss) if None not in peak_rss else None}
+
+
+def compare_to_baseline(results, baseline_path):
+    """Add the ratio of each scenario's time to the baseline's (above 1 is
+    slower) and print a summary table.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)
+    if baseline['settings'] != results['settings']:
+        eprint('WARNING: the baseline was run with different settings')
+    baseline = {i['name']:i for i in baseline['scenarios']}
+
+    eprint('{:<28}{:>12}{:>12}{:>8}'.format('scenario', 'baseline(s)', 'current(s)', 'ratio'))
+    for scenario in results['scenarios']:
+        if scenario['name'] not in baseline:
+            continue
+        old = baseline[scenario['name']]['wall_time']
+        scenario['baseline_wall_time'] = old
+        scenario['baseline_ratio'] = scenario['wall_time'] / old if old > 0 else None
+        eprint('{:<28}{:>12.3f}{:>12.3f}{:>8.2f}'.format(scenario['name'], old, scenario['wall_time'],
+                                                         scenario['baseline_ratio'] or 0))
+
+
+if __name__ == '__main__':
+    args, settings = parse_commandline_arguments()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='benchmark_')
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+    try:
+        data = prepare_data(data_dir, settings)
+
+        results = {'settings': settings,
+                   'python': platform.python_version(),
+                   'pysam': pysam.__version__,
+                   'platform': platform.platform(),
+                   'scenarios': []}
+        for name in SCENARIOS:
+            if args.scenarios is None or name in args.scenarios:
+                eprint('Running {}...'.format(name))
+                results['scenarios'].append(run_scenario(name, data, args.repeat, args.verbose, args.profile))
+                eprint('  {:.3f}s'.format(results['scenarios'][-1]['wall_time']))
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir)
+
+    if args.baseline is not None:
+        compare_to_baseline(results, args.baseline)
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
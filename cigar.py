@@ -0,0 +1,55 @@
+# Purpose: Shared CIGAR decoding for the alignment scripts. Decodes the
+#          introns, exon blocks and query slices of an alignment in a single
+#          pass over the CIGAR operations.
+
+from __future__ import print_function
+
+# pysam CIGAR operation codes
+MATCH, INS, DEL, SKIP, SOFT_CLIP, HARD_CLIP, PAD, EQUAL, DIFF = range(9)
+
+# whether each operation consumes the reference and/or the query sequence
+REF_CONSUMING = (1, 0, 1, 1, 0, 0, 0, 1, 1)
+QUERY_CONSUMING = (1, 1, 0, 0, 1, 0, 0, 1, 1)
+
+
+def parse_CIGAR(pos, cigar):
+    """Walk a pysam formatted CIGAR (a list of (operation, length) tuples) once
+    and return four lists:
+        1) introns: (start, end) of each skip (N) on the reference
+        2) blocks: (start, end) of each exon block on the reference
+        3) query_slices: (start, end) of each block in the query sequence
+        4) block_cigars: the CIGAR operations making up each block
+    Reference coordinates are inclusive and offset by 'pos', so they are 1-based
+    if 'pos' is. Query slices are 0-based and half-open, like Python slices.
+    """
+    introns = []
+    blocks = []
+    query_slices = []
+    block_cigars = []
+
+    if not cigar:
+        return introns, blocks, query_slices, block_cigars
+
+    ref_pos, query_pos = 0, 0
+    block_ref, block_query = 0, 0
+    block_cigar = []
+    for op, length in cigar:
+        if op == SKIP:
+            blocks.append((pos + block_ref, pos + ref_pos - 1))
+            query_slices.append((block_query, query_pos))
+            block_cigars.append(block_cigar)
+            introns.append((pos + ref_pos, pos + ref_pos + length - 1))
+            ref_pos += length
+            block_ref, block_query, block_cigar = ref_pos, query_pos, []
+        else:
+            if REF_CONSUMING[op]:
+                ref_pos += length
+            if QUERY_CONSUMING[op]:
+                query_pos += length
+            block_cigar.append((op, length))
+    blocks.append((pos + block_ref, pos + ref_pos - 1))
+    query_slices.append((block_query, query_pos))
+    block_cigars.append(block_cigar)
+
+    return introns, blocks, query_slices, block_cigars
+
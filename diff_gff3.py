@@ -2,11 +2,19 @@
 #last updated: 22/3/2018
 
 # PURPOSE: Compare multiple GFF3 formatted files and list the features unique
-#          to each, and features shared by all.
+#          to each, features shared by all, and the number of features shared
+#          by each combination of files.
 # USAGE:   diff_gff3.py -i features_1.gff3 features_2.gff3 ... features_N.gff3 -o output_dir -t feature_type
 
 import argparse, errno, operator, os, shutil, sys
-from collections import defaultdict
+import numpy as np
+from collections import defaultdict, OrderedDict
+from gff3 import FeatureList, bgzip_gff3, read_gff3_table, write_gff3
+from metrics import Metrics
+from profiling import Profiler
+
+metrics = Metrics() # timings and counts for each stage, written with --metrics
+profiler = Profiler() # CPU and memory profiles, written with --profile
 
 def print_to_log(*args, **kwargs):
     """Print to both stdout and the log file."""
@@ -30,6 +38,32 @@ def parse_commandline_arguments():
                         type=str,
                         nargs='+',
                         help="[optional] only count features matching 'type' (column 3 in the file)")
+    parser.add_argument('-s',
+                        type=str,
+                        nargs='+',
+                        help="[optional] also output the features common to each of these sets of files, given as file numbers, e.g. '1,2' '1,3,4'")
+    parser.add_argument('--tolerance',
+                        type=int,
+                        default=0,
+                        help='[optional] match features whose start and end positions are each within this many bp (default=0)')
+    parser.add_argument('--cache',
+                        action='store_true',
+                        help="[optional] cache the parsed files next to the input ('<file>.cache'), so later runs on unchanged files skip parsing")
+    parser.add_argument('--region',
+                        type=str,
+                        help="[optional] only compare features in this region ('chrom:start-end'); the files must be bgzipped and tabix indexed")
+    parser.add_argument('-z',
+                        '--bgzip',
+                        action='store_true',
+                        help='[optional] compress the GFF3 output files with bgzip and index them with tabix')
+    parser.add_argument('--metrics',
+                        type=str,
+                        metavar='FILE',
+                        help='[optional] write the time, features emitted and peak memory of each stage to FILE as JSON')
+    parser.add_argument('--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='[optional] profile the run and write a CPU profile and the top memory allocations to DIR')
     parser.add_argument('-f',
                         action='store_true',
                         help='overwrite the output directory if it already exists (THIS WILL OVERWRITE FILES OF THE SAME NAME)')
@@ -49,6 +83,19 @@ def parse_commandline_arguments():
             print('One of more input files could not be found! Exiting.')
             sys.exit(1)
 
+    # parse the sets of files to output
+    subsets = []
+    for i in args.s or []:
+        try:
+            numbers = sorted(set(int(j) for j in i.split(',')))
+        except ValueError:
+            numbers = [0]
+        if len(numbers) < 2 or numbers[0] < 1 or numbers[-1] > len(args.i):
+            print("Invalid set of files '{}'! Exiting.".format(i))
+            sys.exit(1)
+        subsets.append(tuple(args.i[j-1] for j in numbers))
+    args.s = subsets
+
     # default output directory is just <name of this script> + "_output"
     if args.o is None:
         args.o = '{}_output'.format(dirname(sys.argv[0]))
@@ -66,69 +113,301 @@ def file_pairs(files):
     return result
 
 
+def sort_key(positions):
+    """Return a function to sort feature positions by chromosome, then start,
+    end and strand.
+    Note: C. elegans uses roman numerals for chromosomes names.
+    """
+    numerals = {'I':1, 'II':2, 'III':3, 'IV':4, 'V':5, 'X':10, 'MtDNA':11}
+    if all(x[0] in numerals for x in positions):
+        return lambda x: (numerals[x[0]], x[1], x[2], x[3])
+    return lambda x: (x[0], x[1], x[2], x[3])
+
+
 def sort_features(pos):
-    """Sort GFF3 formatted entries by chromosome then start position.
+    """Sort GFF3 formatted entries by chromosome then start position."""
+    return sorted(pos, key=sort_key(pos))
+
+
+def file_positions(table, codes, target=None):
+    """Return the positions of the features (of the target types) in a table,
+    one for each position, as arrays of chromosome and strand codes, start,
+    end and the row of the last feature at the position. 'codes' holds the
+    name:code dictionaries for chromosomes and strands, shared by all files.
+    """
+    rows = table.rows(target)
+    column = {'row': rows}
+    for i in ('seqid', 'strand'):
+        mapping = [codes[i].setdefault(j, len(codes[i])) for j in table.names[i]]
+        column[i] = np.array(mapping, dtype=np.int32)[table.columns[i][rows]]
+    for i in ('start', 'end'):
+        column[i] = np.asarray(table.columns[i][rows])
+
+    # keep the last row at each position (the sort is stable)
+    keys = [column[i] for i in ('strand', 'end', 'start', 'seqid')]
+    order = np.lexsort(keys)
+    same = np.zeros(len(order), dtype=bool) # same position as the next row
+    same[:-1] = True
+    for key in keys:
+        key = key[order]
+        same[:-1] &= key[1:] == key[:-1]
+    order = order[~same]
+
+    return {i:column[i][order] for i in column}
+
+
+def sweep(columns, seqid_names, strand_names):
+    """Merge the positions in each file, sorted by chromosome, then start, end
+    and strand. Returns the file number, the index into the file's columns and
+    the position number of each position in each file, grouped by position in
+    sorted order, and a bitmask of the files each position appears in (bit n
+    is set for the nth file).
     Note: C. elegans uses roman numerals for chromosomes names.
     """
     numerals = {'I':1, 'II':2, 'III':3, 'IV':4, 'V':5, 'X':10, 'MtDNA':11}
-    try:
-        return sorted(pos, key = lambda x: (numerals[x[0]], x[1], x[2], x[3]))
-    except KeyError:
-        return sorted(pos, key = lambda x: (x[0], x[1], x[2], x[3]))
+    seqids = np.concatenate([i['seqid'] for i in columns])
+    present = [seqid_names[i] for i in np.unique(seqids).tolist()]
+    if all(x in numerals for x in present):
+        chrom_ranks = [numerals.get(x, 0) for x in seqid_names]
+    else:
+        chrom_ranks = name_ranks(seqid_names)
+    chroms = np.array(chrom_ranks, dtype=np.int64)[seqids]
+    strands = np.array(name_ranks(strand_names), dtype=np.int64)[np.concatenate([i['strand'] for i in columns])]
+    starts = np.concatenate([i['start'] for i in columns])
+    ends = np.concatenate([i['end'] for i in columns])
+    files = np.concatenate([np.full(len(i['row']), n, dtype=np.int32) for n, i in enumerate(columns)])
+    index = np.concatenate([np.arange(len(i['row'])) for i in columns])
 
+    keys = [files, strands, ends, starts, chroms]
+    order = np.lexsort(keys)
+    same = np.zeros(len(order), dtype=bool) # same position as the previous one
+    same[1:] = True
+    for key in keys[1:]:
+        key = key[order]
+        same[1:] &= key[1:] == key[:-1]
+    positions = np.cumsum(~same) - 1
+    files = files[order]
+    bits = np.array([1 << n for n in range(len(columns))], dtype=np.int64 if len(columns) < 63 else object)
+    masks = np.bitwise_or.reduceat(bits[files], np.flatnonzero(~same))
+
+    return files, index[order], positions, masks
+
+
+def name_ranks(names):
+    """Return the position of each name when the names are sorted."""
+    position = {name:n for n, name in enumerate(sorted(names))}
+    return [position[i] for i in names]
+
+
+class IntervalIndex(object):
+    """The start and end positions of a set of features, as sorted NumPy arrays
+    for each chromosome and strand, for finding features with similar start
+    and end positions.
+
+    Attributes:
+        starts: Sorted start positions for each (chromosome, strand).
+        ends: End positions, in the same order as 'starts'.
+    """
 
-def compare_features(files, target=None):
-    """Compare sets of features and find those unique to each set."""
-    index = {f:{} for f in files}
-    features = {f:set() for f in files}
-    unique = {}
+    def __init__(self, positions):
+        """Return an index of (chromosome, start, end, strand) positions."""
+        groups = defaultdict(list)
+        for chrom, start, end, strand in positions:
+            groups[(chrom, strand)].append((start, end))
+
+        self.starts = {}
+        self.ends = {}
+        for group, coords in groups.items():
+            coords = np.array(sorted(coords), dtype=np.int64).reshape(-1, 2)
+            self.starts[group] = coords[:, 0]
+            self.ends[group] = coords[:, 1]
+
+    def best_matches(self, positions, tolerance):
+        """Return a dictionary of position:best match for each position with a
+        feature whose start and end are both within 'tolerance' bp. The best
+        match is the one with the smallest total distance. Only the features
+        whose start is within the tolerance are compared, one at a time for
+        every position that still has features left to compare.
+        """
+        groups = defaultdict(list)
+        for pos in positions:
+            groups[(pos[0], pos[3])].append(pos)
+
+        matches = {}
+        for group, group_positions in groups.items():
+            if group not in self.starts:
+                continue
+            starts, ends = self.starts[group], self.ends[group]
+            query_starts = np.array([i[1] for i in group_positions], dtype=np.int64)
+            query_ends = np.array([i[2] for i in group_positions], dtype=np.int64)
+            lo = np.searchsorted(starts, query_starts - tolerance, 'left')
+            hi = np.searchsorted(starts, query_starts + tolerance, 'right')
+
+            best = np.full(len(group_positions), -1, dtype=np.int64)
+            best_dist = np.full(len(group_positions), np.iinfo(np.int64).max, dtype=np.int64)
+            active = np.arange(len(group_positions))
+            offset = 0
+            while True:
+                # drop the positions whose window is used up, so the total
+                # cost is the sum of the window sizes
+                active = active[hi[active] - lo[active] > offset]
+                if len(active) == 0:
+                    break
+                idx = lo[active] + offset
+                end_dist = np.abs(ends[idx] - query_ends[active])
+                dist = np.abs(starts[idx] - query_starts[active]) + end_dist
+                better = (end_dist <= tolerance) & (dist < best_dist[active])
+                best[active[better]] = idx[better]
+                best_dist[active[better]] = dist[better]
+                offset += 1
+
+            for pos, i in zip(group_positions, best.tolist()):
+                if i >= 0:
+                    matches[pos] = group[0], int(starts[i]), int(ends[i]), group[1]
+
+        return matches
+
+
+def tolerant_masks(files, features, tolerance):
+    """For each feature in each file, find the best match in every other file
+    within 'tolerance' bp. Returns a bitmask of the files with a match for each
+    position in each file, and the best matches for each position in the first
+    file.
+    """
+    indexes = {f:IntervalIndex(features[f]) for f in files}
+    masks = {}
+    best = defaultdict(dict)
+
+    for n, f in enumerate(files):
+        masks[f] = {pos:1 << n for pos in features[f]}
+        for m, f2 in enumerate(files):
+            if f2 == f:
+                continue
+            matches = indexes[f2].best_matches(features[f], tolerance)
+            for pos, match in matches.items():
+                masks[f][pos] |= 1 << m
+                if n == 0:
+                    best[pos][f2] = match
+
+    return masks, best
+
+
+def compare_features(files, target=None, subsets=(), tolerance=0, cache=False, region=None):
+    """Compare sets of features in a single sorted sweep over all the files.
+    Returns the features unique to each file, the features common to each of
+    'subsets' (each pair of files, if there are three), the features common to
+    all files, the number of features in exactly each combination of files, and
+    (with a tolerance) the best match in each file for features in the first.
+    With a tolerance, features match if their start and end positions are each
+    within 'tolerance' bp, and shared features are counted in the matrix from
+    the first file they appear in. The files are kept as columns, and only the
+    features in the output are built, in batches as the lists are written.
+    With 'cache', the files are loaded through the parsed-file cache. With
+    'region', only the features overlapping it are compared.
+    """
+    tables = []
+    columns = []
+    codes = {'seqid':{}, 'strand':{}}
     paired = {}
-    common = []
+    matrix = defaultdict(int)
 
     if target is not None:
         print('Searching for features matching: {}'.format(' or '.join(target)))
         target = [i.strip() for i in target]
 
-    for x, f in enumerate(files):
-        print_to_log('File #{} = {}'.format(x+1, os.path.abspath(f)))
-        with open(f, 'r') as infile:
-            for n, line in enumerate(infile):
-                line = line.strip()
-                if line[0] != '#':
-                    i = line.split('\t')
-                    f_pos = i[0], int(i[3]), int(i[4]), i[6]
-                    f_type = i[2]
-                    if target is not None and f_type not in target:
-                        continue
-                    features[f].add(f_pos)
-                    index[f][f_pos] = line # Note: if more than one feature
-                                           # shares the same position, only the
-                                           # last feature appearing will be
-                                           # counted.
-        print_to_log("  {:,} features found".format(len(features[f])))
-
-    # list features unique to each file
-    for f in files:
-        f_unique = features[f].copy()
-        for f2 in [i for i in files if i != f]:
-            f_unique -= features[f2]
-        f_unique = sort_features(f_unique) # sort the features by postiion
-        unique[f] = [index[f][i] for i in f_unique] # return the line index for each unique feature
-
-    # get features common to each pair
+    with metrics.stage('parse inputs'):
+        for x, f in enumerate(files):
+            print_to_log('File #{} = {}'.format(x+1, os.path.abspath(f)))
+            tables.append(read_gff3_table(f, cache, region))
+            columns.append(file_positions(tables[-1], codes, target)) # Note: if more
+                                                                      # than one feature
+                                                                      # shares the same
+                                                                      # position, only the
+                                                                      # last feature
+                                                                      # appearing will be
+                                                                      # counted.
+            print_to_log("  {:,} features found".format(len(columns[-1]['row'])))
+    seqid_names, strand_names = [sorted(codes[i], key=codes[i].get) for i in ('seqid', 'strand')]
+
+    # get features common to each pair, or to each requested set of files
+    subsets = list(subsets)
     if 2 < len(files) < 4:
-        for f1, f2 in file_pairs(files):
-            pair_common = set.intersection(features[f1], features[f2])
-            pair_common = sort_features(pair_common)
-            pair_common = [index[f1][i] for i in pair_common] # just use the lines as they appear in the first file
-            paired[(f1, f2)] = pair_common
+        subsets = [tuple(i) for i in file_pairs(files)] + subsets
+    subsets = list(OrderedDict.fromkeys(subsets)) # a pair may also be requested
+    subset_masks = [(subset, sum(1 << files.index(f) for f in subset)) for subset in subsets]
 
-    # get the features common to all files
-    common = set.intersection(*[features[f] for f in files])
-    common = sort_features(common)
-    common = [index[files[0]][i] for i in common] # just use the lines as they appear in the first file
+    all_files = (1 << len(files)) - 1
+    if tolerance > 0:
+        features = {}
+        index = {}
+        for f, column in zip(files, columns):
+            positions = list(zip([seqid_names[i] for i in column['seqid'].tolist()], column['start'].tolist(),
+                                 column['end'].tolist(), [strand_names[i] for i in column['strand'].tolist()]))
+            features[f] = set(positions)
+            index[f] = dict(zip(positions, column['row'].tolist()))
+        key = sort_key(set.union(*features.values()))
+        masks, best = tolerant_masks(files, features, tolerance)
+        unique = {f:[] for f in files}
+        common = []
+        for subset in subsets:
+            paired[subset] = []
+        for n, f in enumerate(files):
+            for pos in sorted(features[f], key=key):
+                mask = masks[f][pos]
+                if mask & ((1 << n) - 1) == 0: # not in an earlier file
+                    matrix[mask] += 1
+                if mask == 1 << n:
+                    unique[f].append(index[f][pos])
+                if n == 0 and mask == all_files:
+                    common.append(index[f][pos])
+                for subset, subset_mask in subset_masks:
+                    if f == subset[0] and mask & subset_mask == subset_mask:
+                        paired[subset].append(index[f][pos])
+        as_features = lambda f, rows: FeatureList(tables[files.index(f)], np.array(rows, dtype=np.int64))
+        unique = {f:as_features(f, unique[f]) for f in files}
+        paired = {subset:as_features(subset[0], paired[subset]) for subset in subsets}
+        return unique, paired, as_features(files[0], common), matrix, best
 
-    return unique, paired, common
+    member_files, member_index, member_positions, masks = sweep(columns, seqid_names, strand_names)
+    for mask, count in zip(*np.unique(masks, return_counts=True)):
+        matrix[int(mask)] += int(count)
+
+    def as_features(n, selected):
+        """The features in file n at the selected positions (in sorted order)."""
+        in_file = np.flatnonzero(member_files == n)
+        found = in_file[np.searchsorted(member_positions[in_file], selected)]
+        return FeatureList(tables[n], columns[n]['row'][member_index[found]])
+
+    unique = {f:as_features(n, np.flatnonzero(masks == 1 << n)) for n, f in enumerate(files)}
+    common = as_features(0, np.flatnonzero(masks == all_files)) # just use the features as they appear in the first file
+    for subset, subset_mask in subset_masks:
+        paired[subset] = as_features(files.index(subset[0]), np.flatnonzero(masks & subset_mask == subset_mask))
+
+    return unique, paired, common, matrix, {}
+
+
+def write_best_matches(files, best, path):
+    """Write the best match in each other file for the features in the first
+    file that matched at least one other file.
+    """
+    format_pos = lambda x: '{}:{}-{}({})'.format(*x)
+    with open(path, 'w') as outf:
+        print(*['file_{}'.format(x+1) for x in range(len(files))], sep='\t', file=outf)
+        for pos in sort_features(best):
+            row = [format_pos(pos)] + [format_pos(best[pos][f]) if f in best[pos] else '.' for f in files[1:]]
+            print(*row, sep='\t', file=outf)
+
+
+def write_matrix(files, matrix, path):
+    """Write the number of features in exactly each combination of files, as
+    a table with one column per file (1 if the features are in the file),
+    largest combinations first.
+    """
+    with open(path, 'w') as outf:
+        print(*['file_{}'.format(x+1) for x in range(len(files))] + ['features'], sep='\t', file=outf)
+        for mask, count in sorted(matrix.items(), key=lambda x: (-x[1], x[0])):
+            row = [(mask >> x) & 1 for x in range(len(files))]
+            print(*row + [count], sep='\t', file=outf)
 
 
 if __name__ == '__main__':
@@ -136,6 +415,13 @@ if __name__ == '__main__':
     files = args.i
     out_path = args.o
     f_type = args.t
+    subsets = args.s
+    tolerance = args.tolerance
+    cache = args.cache
+    metrics.path = args.metrics
+    profiler.start(args.profile)
+    region = args.region
+    bgzip = args.bgzip
     force = args.f
 
     # Make a directory to output the results to
@@ -149,33 +435,42 @@ if __name__ == '__main__':
             sys.exit(1)
 
     log = open(out_path + '/files.log', 'w')
-    unique, paired, common = compare_features(files, f_type)
-
-    # output the features common to all files
-    print_to_log('{:,} features common to all files'.format(len(common)))
-    with open(out_path + '/features_common_to_all.gff3', 'w') as outf:
-        print('##gff-version 3', file=outf)
-        for line in common:
-            print(line, file=outf)
-
-    # output the results common to each pair of files
-    if len(paired) > 0:
-        for f1, f2 in sorted(paired):
-            x1, x2 = files.index(f1)+1, files.index(f2)+1
-            lines = paired[(f1, f2)]
-            print_to_log('  {:,} features common to files #{} and #{}'.format(len(lines), x1, x2))
-            with open(out_path + '/features_common_to_{}_and_{}.gff3'.format(x1, x2), 'w') as outf:
-                print('##gff-version 3', file=outf)
-                for line in lines:
-                    print(line, file=outf)
-
-    # output the features unique to each files
-    for x, f in enumerate(files):
-        print_to_log("{:,} features unique to file #{}".format(len(unique[f]), x+1))
-        with open(out_path + '/features_unique_to_{}.gff3'.format(x+1), 'w') as outf:
-            print('##gff-version 3', file=outf)
-            for line in unique[f]:
-                print(line, file=outf)
+    with metrics.stage('parse and compare'):
+        unique, paired, common, matrix, best = compare_features(files, f_type, subsets, tolerance, cache, region)
+
+    with metrics.stage('write'):
+        # output the features common to all files
+        print_to_log('{:,} features common to all files'.format(len(common)))
+        gff3_paths = [out_path + '/features_common_to_all.gff3']
+        with open(gff3_paths[-1], 'w') as outf:
+            metrics.count(features=write_gff3(common, outf))
+
+        # output the results common to each pair (or requested set) of files
+        for subset, lines in paired.items():
+            numbers = [str(files.index(f)+1) for f in subset]
+            print_to_log('  {:,} features common to files #{}'.format(len(lines), ' and #'.join(numbers)))
+            gff3_paths.append(out_path + '/features_common_to_{}.gff3'.format('_and_'.join(numbers)))
+            with open(gff3_paths[-1], 'w') as outf:
+                metrics.count(features=write_gff3(lines, outf))
+
+        # output the features unique to each files
+        for x, f in enumerate(files):
+            print_to_log("{:,} features unique to file #{}".format(len(unique[f]), x+1))
+            gff3_paths.append(out_path + '/features_unique_to_{}.gff3'.format(x+1))
+            with open(gff3_paths[-1], 'w') as outf:
+                metrics.count(features=write_gff3(unique[f], outf))
+
+        # output the number of features in each combination of files
+        write_matrix(files, matrix, out_path + '/intersections.tsv')
+        if tolerance > 0:
+            write_best_matches(files, best, out_path + '/best_matches.tsv')
+
+    if bgzip:
+        with metrics.stage('compress'):
+            for path in gff3_paths:
+                bgzip_gff3(path)
 
     print_to_log('Wrote output to', os.path.abspath(out_path))
     log.close()
+    profiler.stop()
+    metrics.write()
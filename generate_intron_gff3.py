@@ -6,8 +6,22 @@
 #          count read support for each one.
 
 import pysam
-import argparse, os, sys
+import argparse, hashlib, json, os, sys
+import numpy as np
 from collections import defaultdict
+from multiprocessing import Pool
+from cigar import parse_CIGAR
+from gff3 import Feature, GFF3Table, bgzip_gff3, read_gff3, write_gff3
+from metrics import Metrics
+from profiling import Profiler
+
+CHUNK_SIZE = 10000000 # largest genomic chunk handed to each worker
+MIN_CHUNK_SIZE = 100000 # smallest genomic chunk handed to each worker
+CHUNKS_PER_PROCESS = 8 # aim for this many chunks per worker, to balance the load
+COUNT_CACHE_VERSION = 1 # change when the way introns are counted changes
+
+metrics = Metrics() # timings and counts for each stage, written with --metrics
+profiler = Profiler() # CPU, memory and per-read profiles, written with --profile
 
 def parse_commandline_arguments():
     parser = argparse.ArgumentParser(description='Count the number of supporting reads for each intron.')
@@ -28,13 +42,43 @@ def parse_commandline_arguments():
                         '--strand-only',
                         action='store_true',
                         help='discard any introns without a defined strand')
+    parser.add_argument('-p',
+                        '--processes',
+                        type=int,
+                        default=1,
+                        help='number of worker processes (default=1)')
+    parser.add_argument('-c',
+                        '--cache',
+                        action='store_true',
+                        help="cache the intron counts of each SAM/BAM file ('<file>.introns.npz') and the parsed GFF3 file given with -i ('<file>.cache') next to them, so later runs only read new or changed files")
+    parser.add_argument('--region',
+                        type=str,
+                        help="only read the introns given with -i in this region ('chrom:start-end'); the file must be bgzipped and tabix indexed")
+    parser.add_argument('-z',
+                        '--bgzip',
+                        type=str,
+                        metavar='FILE',
+                        help="write the output to FILE, compressed with bgzip and indexed with tabix ('FILE.gz' and 'FILE.gz.tbi')")
+    parser.add_argument('-x',
+                        '--matrix',
+                        type=str,
+                        metavar='FILE',
+                        help='also count the introns of each SAM/BAM file separately and write them to FILE as a compressed sparse introns x samples matrix (NumPy .npz, readable with scipy.sparse.load_npz), with the rows in the same order as the GFF3 output')
+    parser.add_argument('--metrics',
+                        type=str,
+                        metavar='FILE',
+                        help='write the time, reads decoded, features emitted and peak memory of each stage to FILE as JSON')
+    parser.add_argument('--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='profile the main process and write a CPU profile, the top memory allocations and a sampled time-per-read histogram to DIR')
     args = parser.parse_args()
 
     if args.a is None:
         parser.print_help()
         sys.exit(1)
 
-    return args.a, args.i, args.m, args.strand_only
+    return args.a, args.i, args.m, args.strand_only, args.processes, args.cache, args.region, args.bgzip, args.matrix, args.metrics, args.profile
 
 
 def eprint(*args, **kwargs):
@@ -50,62 +94,255 @@ def optype(path, op='r'):
     return op
 
 
-def parse_CIGAR(chrom, pos, cigar):
-    """Get the pos, end, and size of any introns from the CIGAR string.
-    if(  cigar_type == 0): #match
-    elif(cigar_type == 1): #insertions
-    elif(cigar_type == 2): #deletion
-    elif(cigar_type == 3): #skip
-    elif(cigar_type == 4): #soft clipping
-    elif(cigar_type == 5): #hard clipping
-    elif(cigar_type == 6): #padding
-    """
-    introns = list()
-
-    cigar_type = [i[0] for i in cigar]
-    cigar_len = [i[1] for i in cigar]
-
-    for i in [i for i, l in enumerate(cigar_type) if l == 3]:
-        size = cigar_len[i]
-        start = pos
-        for j in range(len(cigar_type[:i])):
-            if cigar_type[j] in [0, 2, 3]:
-                start += cigar_len[j]
-        end = start + size - 1
-
-        introns.append([chrom, start, end])
+class IntronCountCache(object):
+    """The intron counts of one SAM/BAM file, saved next to it in a compressed
+    NumPy file ('<file>.introns.npz'). The counts are only used if the size and
+    modification time of the file, and the checksum of its index, are the same
+    as when they were saved.
 
-    return introns
+    Attributes:
+        bam_path: The path of the SAM/BAM file.
+        path: The path of the cache file.
+    """
 
+    def __init__(self, bam_path):
+        self.bam_path = bam_path
+        self.path = bam_path + '.introns.npz'
+
+    def index_checksum(self):
+        """Return the MD5 checksum of the index of the file (or None)."""
+        root = os.path.splitext(self.bam_path)[0]
+        for index_path in (self.bam_path + '.bai', root + '.bai', self.bam_path + '.csi', root + '.csi'):
+            if os.path.exists(index_path):
+                md5 = hashlib.md5()
+                with open(index_path, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        md5.update(block)
+                return md5.hexdigest()
+        return None
+
+    def identity(self):
+        stat = os.stat(self.bam_path)
+        return json.dumps([stat.st_size, stat.st_mtime, self.index_checksum(), COUNT_CACHE_VERSION])
+
+    def load(self):
+        """Return the saved counts as a dictionary of intron:count, or None if
+        there are none or they're out of date.
+        """
+        try:
+            with np.load(self.path, allow_pickle=False) as f:
+                if str(f['identity']) != self.identity():
+                    return None
+                chroms, strands = f['chroms'].tolist(), f['strands'].tolist()
+                introns = zip([chroms[i] for i in f['chrom'].tolist()], f['start'].tolist(), f['end'].tolist(),
+                              [strands[i] for i in f['strand'].tolist()])
+                return dict(zip(introns, f['count'].tolist()))
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def save(self, count_dict):
+        """Save a dictionary of intron:count."""
+        chroms, strands = {}, {}
+        columns = ([chroms.setdefault(i[0], len(chroms)) for i in count_dict], [i[1] for i in count_dict],
+                   [i[2] for i in count_dict], [strands.setdefault(i[3], len(strands)) for i in count_dict])
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, identity=np.array(self.identity()),
+                                    chroms=np.array(sorted(chroms, key=chroms.get), dtype=str),
+                                    strands=np.array(sorted(strands, key=strands.get), dtype=str),
+                                    chrom=np.array(columns[0], dtype=np.int32),
+                                    start=np.array(columns[1], dtype=np.int64),
+                                    end=np.array(columns[2], dtype=np.int64),
+                                    strand=np.array(columns[3], dtype=np.int8),
+                                    count=np.array(list(count_dict.values()), dtype=np.int64))
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            eprint('  Could not save the intron counts of {}: {}'.format(self.bam_path, e))
+
+
+class SampleMatrix(object):
+    """The intron counts of each input file, kept as one sparse column per file
+    and written as a compressed introns x samples matrix. The file holds the
+    matrix in CSR form under the same names as scipy.sparse.save_npz ('data',
+    'indices', 'indptr', 'format', 'shape'), so scipy.sparse.load_npz() reads
+    it directly, plus the labels of the rows ('introns', as
+    'chrom:start-end:strand') and of the columns ('samples', the file paths).
+
+    Attributes:
+        samples: The column labels, in the order the files were added.
+        rows: A dictionary of intron:row number, in the order first seen.
+        columns: The (row numbers, counts) arrays of each file.
+    """
 
-def find_introns(bamfile, count_dict):
+    def __init__(self):
+        self.samples = []
+        self.rows = {}
+        self.columns = []
+
+    def add(self, sample, count_dict):
+        """Add a dictionary of intron:count as the column of a sample."""
+        rows = [self.rows.setdefault(i, len(self.rows)) for i in count_dict]
+        self.columns.append((np.array(rows, dtype=np.int64), np.array(list(count_dict.values()), dtype=np.int64)))
+        self.samples.append(sample)
+
+    def write(self, path, introns):
+        """Write the matrix to 'path', with a row for each intron in 'introns'
+        (in that order). Returns the number of non-zero counts written.
+        """
+        order = np.full(len(self.rows), -1, dtype=np.int64)
+        for n, intron in enumerate(introns):
+            row = self.rows.get(intron)
+            if row is not None:
+                order[row] = n
+        row_parts, col_parts, data_parts = [], [], []
+        for col, (rows, counts) in enumerate(self.columns):
+            rows = order[rows]
+            keep = (rows >= 0) & (counts != 0)
+            row_parts.append(rows[keep])
+            col_parts.append(np.full(np.count_nonzero(keep), col, dtype=np.int32))
+            data_parts.append(counts[keep])
+        rows = np.concatenate(row_parts) if row_parts else np.zeros(0, dtype=np.int64)
+        cols = np.concatenate(col_parts) if col_parts else np.zeros(0, dtype=np.int32)
+        data = np.concatenate(data_parts) if data_parts else np.zeros(0, dtype=np.int64)
+        sort = np.lexsort((cols, rows))
+        indptr = np.zeros(len(introns) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(introns)), out=indptr[1:])
+
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, format=np.array('csr'), shape=np.array([len(introns), len(self.samples)]),
+                                data=data[sort], indices=cols[sort], indptr=indptr,
+                                introns=np.array(['{}:{}-{}:{}'.format(*i) for i in introns], dtype=str),
+                                samples=np.array(self.samples, dtype=str))
+        return len(data)
+
+
+def find_introns(bamfile, count_dict, region=None):
     """Read though the BAM file and find all introns, as specified in the CIGAR
-    string, with number of supporting reads.
+    string, with number of supporting reads. If a region (chrom, start, end) is
+    given, only count reads starting inside it, so that adjacent regions never
+    count the same read twice.
     """
-    for line in bamfile.fetch():
+    if region is None:
+        alignments = bamfile.fetch()
+    else:
+        region_chrom, region_start, region_end = region
+        alignments = (l for l in bamfile.fetch(region_chrom, region_start, region_end) if l.pos >= region_start)
+
+    reads = 0
+    for line in profiler.sample('find_introns', alignments):
+        reads += 1
         chrom = bamfile.get_reference_name(line.rname)
         pos = line.pos + 1
-        cigar = line.cigar
+        cigar = line.cigartuples
         if line.has_tag('XS'):
             strand = line.get_tag('XS')
         else:
             strand = '.'
-        for intron in parse_CIGAR(chrom, pos, cigar):
-            intron = tuple(intron + [strand])
-            count_dict[intron] += 1
+        for start, end in parse_CIGAR(pos, cigar)[0]:
+            count_dict[(chrom, start, end, strand)] += 1
+    metrics.count(reads=reads)
+
+    return count_dict
+
+
+def genomic_chunks(bamfile, processes=1):
+    """Split each reference with mapped reads into equal-size chunks, in the
+    same order that bamfile.fetch() would visit them. The chunk size gives each
+    worker about CHUNKS_PER_PROCESS chunks, within MIN_CHUNK_SIZE and
+    CHUNK_SIZE.
+    """
+    mapped = {i.contig:i.mapped for i in bamfile.get_index_statistics()}
+    total = sum(length for chrom, length in zip(bamfile.references, bamfile.lengths) if mapped.get(chrom, 0) > 0)
+    chunk_size = min(CHUNK_SIZE, max(MIN_CHUNK_SIZE, total // (processes * CHUNKS_PER_PROCESS)))
+    for chrom, length in zip(bamfile.references, bamfile.lengths):
+        if mapped.get(chrom, 0) > 0:
+            for start in range(0, length, chunk_size):
+                yield chrom, start, min(start + chunk_size, length)
+
+
+def find_introns_in_chunk(task):
+    """Worker function: count the introns in one chunk of a BAM file using a
+    separate file handle. Returns the number of reads decoded and the counts.
+    """
+    path, region = task
+    with pysam.AlignmentFile(path, optype(path, 'r')) as bamfile, metrics.stage('scan chunk') as stage:
+        count_dict = find_introns(bamfile, defaultdict(int), region)
+
+    return stage['reads'], dict(count_dict)
+
+
+def find_introns_parallel(bamfiles, count_dict, processes):
+    """Count introns in each BAM file by splitting the work into genomic chunks
+    across a pool of worker processes. Results are merged in chunk order, so the
+    output is identical to reading each file serially.
+    """
+    tasks = []
+    for b in bamfiles:
+        path = b.filename.decode()
+        if not b.has_index():
+            eprint('  {} is not indexed, reading it in serial'.format(path))
+            count_dict = find_introns(b, count_dict)
+            continue
+        tasks.extend((path, region) for region in genomic_chunks(b, processes))
+
+    pool = Pool(processes, initializer=profiler.detach)
+    try:
+        for reads, chunk_counts in pool.imap(find_introns_in_chunk, tasks):
+            metrics.count(reads=reads)
+            for intron, count in chunk_counts.items():
+                count_dict[intron] += count
+    finally:
+        pool.close()
+        pool.join()
+
+    return count_dict
+
+
+def count_introns(bamfile, processes=1):
+    """Return the intron counts of one SAM/BAM file."""
+    if processes > 1:
+        return find_introns_parallel([bamfile], defaultdict(int), processes)
+    return find_introns(bamfile, defaultdict(int))
+
+
+def find_introns_per_file(bamfiles, count_dict, processes=1, cache=False, matrix=None):
+    """Count the introns of each file separately and add them to 'count_dict'.
+    With 'cache', use the saved counts of unchanged files and save the counts
+    of new or changed files. With 'matrix' (a SampleMatrix), also keep the
+    counts of each file as a column of the matrix.
+    """
+    cached = 0
+    for b in bamfiles:
+        path = b.filename.decode()
+        counts = None
+        if cache:
+            count_cache = IntronCountCache(path)
+            counts = count_cache.load()
+        if counts is None:
+            counts = count_introns(b, processes)
+            if cache:
+                count_cache.save(counts)
+        else:
+            cached += 1
+        if matrix is not None:
+            matrix.add(path, counts)
+        for intron, count in counts.items():
+            count_dict[intron] += count
+    if cache:
+        eprint('  Used the saved intron counts of {:,} of {:,} file(s)'.format(cached, len(bamfiles)))
 
     return count_dict
 
 
-def parse_gff3(path):
+def parse_gff3(path, cache=False, region=None):
+    if cache and region is None: # a region is read through the tabix index
+        return set(GFF3Table.load(path).positions())
+
     intron_set = set()
 
-    with open(path, 'r') as f:
-        for line in f:
-            if not line.startswith('#'):
-                line = line.split('\t')
-                intron = line[0], int(line[3]), int(line[4]), line[6]
-                intron_set.add(intron)
+    for feature in read_gff3(path, region=region):
+        intron_set.add(feature.position())
 
     return intron_set
 
@@ -121,50 +358,56 @@ def sort_features(introns):
         return sorted(introns, key=lambda x: (x[0], int(x[1]), int(x[2])))
 
 
-def output_as_gff3(count_dict):
-    """Ouptut the results in GFF3 format."""
-    print('##gff-version 3')
-    for n, intron in enumerate(sort_features(count_dict)):
-        chrom, start, end, strand = intron
-        count = count_dict[intron]
-        line = chrom, '.', 'intron', start, end, count, strand, '.', 'ID='+str(n+1)
-        print(*line, sep='\t')
+def output_as_gff3(count_dict, outfile=None):
+    """Ouptut the results in GFF3 format (to stdout, or an open file)."""
+    features = (Feature(chrom, '.', 'intron', start, end, count_dict[intron], strand, '.', 'ID='+str(n+1))
+                for n, intron in enumerate(sort_features(count_dict))
+                for chrom, start, end, strand in [intron])
+    write_gff3(features, outfile)
 
 
-def run(bamfiles, gff_path):
+def run(bamfiles, gff_path, processes=1, cache=False, region=None, matrix=None):
     count_dict = defaultdict(int)
 
-    for b in bamfiles:
-        count_dict = find_introns(b, count_dict)
+    with metrics.stage('scan BAM'):
+        if cache or matrix is not None:
+            count_dict = find_introns_per_file(bamfiles, count_dict, processes, cache, matrix)
+        elif processes > 1:
+            count_dict = find_introns_parallel(bamfiles, count_dict, processes)
+        else:
+            for b in bamfiles:
+                count_dict = find_introns(b, count_dict)
     eprint('Found {:,} introns in {} file(s)'.format(len(count_dict), len(bamfiles)))
 
     if gff_path is not None:
-        intron_set = parse_gff3(gff_path)
+        with metrics.stage('parse inputs'):
+            intron_set = parse_gff3(gff_path, cache, region)
         eprint('{:,} introns specified in file: {}'.format(len(intron_set), gff_path))
         # add in any introns that were in the GFF3 file, but not found
         for intron in intron_set:
             if intron not in count_dict:
                 count_dict[intron] = 0
         # only report introns in the specified set
-        for intron, _ in count_dict.items():
+        for intron in list(count_dict):
             if intron not in intron_set:
                 del count_dict[intron]
 
     # discard any introns not meeting filtering criteria
-    del_set = set()
-    m, n = 0, 0
-    for intron, count in count_dict.items():
-        to_del = False
-        if count < min_count:
-            to_del = True
-            m += 1
-        if intron[3] not in ('+', '-') and strand_only:
-            to_del
-            n += 1
-        if to_del:
-            del_set.add(intron)
-    for intron in del_set:
-        del count_dict[intron]
+    with metrics.stage('filter'):
+        del_set = set()
+        m, n = 0, 0
+        for intron, count in count_dict.items():
+            to_del = False
+            if count < min_count:
+                to_del = True
+                m += 1
+            if intron[3] not in ('+', '-') and strand_only:
+                to_del
+                n += 1
+            if to_del:
+                del_set.add(intron)
+        for intron in del_set:
+            del count_dict[intron]
 
     if m > 0:
         eprint('  Discarding {:,} introns with less than {} support'.format(m, min_count))
@@ -175,7 +418,22 @@ def run(bamfiles, gff_path):
 
 
 if __name__ == '__main__':
-    bam_paths, gff_path, min_count, strand_only = parse_commandline_arguments()
+    bam_paths, gff_path, min_count, strand_only, processes, cache, region, bgzip_path, matrix_path, metrics.path, profile_dir = parse_commandline_arguments()
+    profiler.start(profile_dir)
     bamfiles = [pysam.AlignmentFile(b, optype(b, op='r')) for b in bam_paths]
-    count_dict = run(bamfiles, gff_path)
-    output_as_gff3(count_dict)
+    matrix = SampleMatrix() if matrix_path is not None else None
+    count_dict = run(bamfiles, gff_path, processes, cache, region, matrix)
+    with metrics.stage('sort and write'):
+        if bgzip_path is None:
+            output_as_gff3(count_dict)
+        else:
+            with open(bgzip_path, 'w') as f:
+                output_as_gff3(count_dict, f)
+            eprint('Wrote output to {}'.format(bgzip_gff3(bgzip_path)))
+        metrics.count(features=len(count_dict))
+    if matrix is not None:
+        with metrics.stage('write matrix'):
+            n = matrix.write(matrix_path, sort_features(count_dict))
+        eprint('Wrote {:,} introns x {} samples ({:,} non-zero counts) to {}'.format(len(count_dict), len(matrix.samples), n, matrix_path))
+    profiler.stop()
+    metrics.write()
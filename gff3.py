@@ -0,0 +1,394 @@
+# Purpose: Shared GFF3 reading and writing for the GFF3 scripts. Features are
+#          stored in a compact record with interned sequence names, sources and
+#          types. The attributes column is kept as a string, and only parsed
+#          when the attributes are accessed.
+
+from __future__ import print_function
+import gzip, json, os, shutil, sys
+from collections import OrderedDict
+
+try:
+    intern = sys.intern
+except AttributeError:
+    pass # Python 2: intern() is a builtin
+
+class Feature(object):
+    """A single GFF3 feature. Coordinates are 1-based and inclusive.
+
+    Attributes:
+        seqid: The sequence (chromosome) name.
+        source: The source column.
+        type: The feature type (column 3).
+        start: The start position (int).
+        end: The end position (int).
+        score: The score column, as it appears in the file.
+        strand: '+', '-' or '.'.
+        phase: The phase column.
+        attr_string: The attributes column, unparsed.
+    """
+    __slots__ = ('seqid', 'source', 'type', 'start', 'end', 'score', 'strand', 'phase', 'attr_string', '_attributes')
+
+    def __init__(self, seqid, source, type, start, end, score='.', strand='.', phase='.', attr_string='.'):
+        self.seqid = seqid
+        self.source = source
+        self.type = type
+        self.start = start
+        self.end = end
+        self.score = score
+        self.strand = strand
+        self.phase = phase
+        self.attr_string = attr_string
+        self._attributes = None
+
+    @property
+    def attributes(self):
+        """Return the attributes as a dictionary of tag:value, parsing them the
+        first time they're needed.
+        """
+        if self._attributes is None:
+            self._attributes = {}
+            if self.attr_string not in ('', '.'):
+                for i in self.attr_string.split(';'):
+                    if len(i) > 0:
+                        tag, val = i.split('=', 1)
+                        self._attributes[tag] = val
+        return self._attributes
+
+    def position(self):
+        """Return the (chromosome, start, end, strand) of the feature."""
+        return self.seqid, self.start, self.end, self.strand
+
+    def to_line(self):
+        """Return the feature as a line in GFF3 format (without a newline)."""
+        return '\t'.join((self.seqid, self.source, self.type, str(self.start), str(self.end),
+                          str(self.score), self.strand, self.phase, self.attr_string))
+
+    def __repr__(self):
+        return 'Feature({})'.format(self.to_line().replace('\t', ' '))
+
+
+def split_line(line):
+    """Split a line in GFF3 format into its nine columns, with '.' for missing
+    attributes.
+    """
+    col = line.rstrip('\r\n').split('\t')
+    if len(col) < 9:
+        col.append('.')
+    return col[:9]
+
+
+def parse_line(line):
+    """Parse a line in GFF3 format and return a Feature."""
+    col = split_line(line)
+    return Feature(intern(col[0]), intern(col[1]), intern(col[2]), int(col[3]), int(col[4]),
+                   col[5], intern(col[6]), intern(col[7]), col[8])
+
+
+def open_gff3(path):
+    """Open a GFF3 file for reading, decompressing it if it ends in '.gz'."""
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt')
+    return open(path, 'r')
+
+
+def fetch_region(path, region):
+    """Yield the lines of a bgzipped and tabix indexed GFF3 file overlapping a
+    region ('chrom', 'chrom:start' or 'chrom:start-end').
+    """
+    import pysam # only needed for indexed files
+
+    with pysam.TabixFile(path) as tbx:
+        chrom = region if region in tbx.contigs else region.rsplit(':', 1)[0]
+        if chrom not in tbx.contigs:
+            return
+        for line in tbx.fetch(region=region):
+            yield line
+
+
+def read_lines(infile, region=None):
+    """Yield each line of a GFF3 file (a path or an open file), skipping
+    comments and blank lines. If 'region' is given, the file must be a path to
+    a bgzipped and tabix indexed file, and only the lines overlapping the
+    region are read.
+    """
+    if region is not None:
+        for line in read_lines(fetch_region(infile, region)):
+            yield line
+        return
+    if isinstance(infile, str):
+        with open_gff3(infile) as f:
+            for line in read_lines(f):
+                yield line
+        return
+
+    for line in infile:
+        if len(line.strip()) == 0 or line[0] == '#':
+            continue
+        yield line
+
+
+def read_gff3(infile, types=None, region=None):
+    """Yield a Feature for each line of a GFF3 file (a path or an open file),
+    skipping comments and blank lines. If 'types' is given, only features of
+    those types are returned. If 'region' is given, the file must be a path to
+    a bgzipped and tabix indexed file, and only the features overlapping the
+    region are read.
+    """
+    for line in read_lines(infile, region):
+        feature = parse_line(line)
+        if types is None or feature.type in types:
+            yield feature
+
+
+def write_gff3(features, outfile=None, header=('##gff-version 3',)):
+    """Write the header lines, then each feature, to an open file (default:
+    stdout). Returns the number of features written.
+    """
+    if outfile is None:
+        outfile = sys.stdout
+    for line in header:
+        print(line, file=outfile)
+    count = 0
+    for feature in features:
+        print(feature.to_line(), file=outfile)
+        count += 1
+    return count
+
+
+def bgzip_gff3(path):
+    """Compress a GFF3 file sorted by position with bgzip and index it with
+    tabix, replacing it with '<path>.gz' and '<path>.gz.tbi'. Returns the path
+    of the compressed file.
+    """
+    import pysam # only needed for indexed files
+
+    return pysam.tabix_index(path, preset='gff', force=True)
+
+
+##########################
+# Parsed GFF3 file cache #
+##########################
+CACHE_VERSION = 1
+CACHE_COLUMNS = ('seqid', 'source', 'type', 'strand', 'phase') # stored as codes into a list of names
+CACHE_STRINGS = ('score', 'attr_string') # stored as one byte array with offsets
+FEATURE_BATCH = 10000 # number of rows built into Features at once
+PARSE_BATCH = 100000 # number of features parsed before they're packed into arrays
+
+class GFF3Table(object):
+    """The columns of a parsed GFF3 file, as NumPy arrays that are saved to a
+    directory next to the file ('<path>.cache') and memory-mapped when loaded
+    again. The cache is rebuilt whenever the path, size or modification time of
+    the file changes. Features are only built when they're requested, so the
+    tools that hold whole files in memory keep them as a table.
+
+    Attributes:
+        path: The path of the GFF3 file.
+        names: The list of names for each column stored as codes.
+        columns: A NumPy array for each column.
+    """
+
+    def __init__(self, path, names, columns):
+        self.path = path
+        self.names = names
+        self.columns = columns
+
+    @staticmethod
+    def cache_path(path):
+        return path + '.cache'
+
+    @staticmethod
+    def identity(path):
+        """Return the identity of a file: absolute path, size and mtime."""
+        stat = os.stat(path)
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime, CACHE_VERSION]
+
+    @classmethod
+    def load(cls, path):
+        """Return the table for a GFF3 file, from the cache if it's current;
+        otherwise parse the file and save the cache.
+        """
+        import numpy as np # only needed for GFF3Table
+
+        cache_path = cls.cache_path(path)
+        try:
+            with open(os.path.join(cache_path, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            if meta['identity'] == cls.identity(path):
+                columns = {}
+                for name in meta['arrays']:
+                    columns[name] = np.load(os.path.join(cache_path, name + '.npy'), mmap_mode='r')
+                return cls(path, meta['names'], columns)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+        table = cls.parse(path)
+        try:
+            table.save()
+        except (IOError, OSError) as e:
+            print('Could not write GFF3 cache for {}: {}'.format(path, e), file=sys.stderr)
+
+        return table
+
+    @classmethod
+    def parse(cls, path, region=None):
+        """Parse a GFF3 file (the features overlapping 'region') into columns.
+        The lines are split and packed into arrays a column at a time, and
+        PARSE_BATCH lines at a time, so only one batch is held as Python
+        objects.
+        """
+        import numpy as np # only needed for GFF3Table
+
+        identity = cls.identity(path)
+        codes = {i:{} for i in CACHE_COLUMNS}
+        batches = {i:[] for i in CACHE_COLUMNS + CACHE_STRINGS + ('start', 'end', 'score_lengths', 'attr_string_lengths')}
+
+        def pack(lines):
+            rows = [i.rstrip('\r\n').split('\t') for i in lines]
+            if len(rows) > 0 and (min(map(len, rows)) < 9 or max(map(len, rows)) > 9):
+                rows = [split_line(i) for i in lines]
+            fields = list(zip(*rows)) or [()] * 9
+            for i, n in zip(CACHE_COLUMNS, (0, 1, 2, 6, 7)):
+                for j in OrderedDict.fromkeys(fields[n]): # new names in order of appearance
+                    codes[i].setdefault(j, len(codes[i]))
+                batches[i].append(np.array(list(map(codes[i].__getitem__, fields[n])), dtype=np.int32))
+            for i, n in (('start', 3), ('end', 4)):
+                batches[i].append(np.array(list(map(int, fields[n])), dtype=np.int64))
+            for i, n in zip(CACHE_STRINGS, (5, 8)):
+                encoded = [j.encode() for j in fields[n]]
+                batches[i + '_lengths'].append(np.array(list(map(len, encoded)), dtype=np.int64))
+                batches[i].append(np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+        lines = []
+        for line in read_lines(path, region):
+            lines.append(line)
+            if len(lines) == PARSE_BATCH:
+                pack(lines)
+                lines = []
+        pack(lines)
+
+        columns = {}
+        for i in CACHE_COLUMNS + ('start', 'end'):
+            columns[i] = np.concatenate(batches.pop(i))
+        for i in CACHE_STRINGS:
+            columns[i + '_offsets'] = np.concatenate([[0], np.cumsum(np.concatenate(batches.pop(i + '_lengths')))]).astype(np.int64)
+            columns[i + '_bytes'] = np.concatenate(batches.pop(i))
+        names = {i:sorted(codes[i], key=codes[i].get) for i in CACHE_COLUMNS}
+
+        table = cls(path, names, columns)
+        table.identity_at_parse = identity
+        return table
+
+    def save(self):
+        """Save the columns to the cache directory."""
+        import numpy as np # only needed for GFF3Table
+
+        cache_path = self.cache_path(self.path)
+        tmp_path = cache_path + '.tmp'
+        if os.path.isdir(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        for name, array in self.columns.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), array)
+        meta = {'identity': getattr(self, 'identity_at_parse', self.identity(self.path)),
+                'names': self.names, 'arrays': sorted(self.columns)}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        if os.path.isdir(cache_path):
+            shutil.rmtree(cache_path)
+        os.rename(tmp_path, cache_path)
+
+    def __len__(self):
+        return len(self.columns['start'])
+
+    def rows(self, types=None):
+        """Return the row numbers of the features (of the given types)."""
+        import numpy as np # only needed for GFF3Table
+
+        if types is None:
+            return np.arange(len(self))
+        codes = [n for n, i in enumerate(self.names['type']) if i in types]
+        return np.flatnonzero(np.isin(self.columns['type'], codes))
+
+    def positions(self, rows=None):
+        """Return a list of (chromosome, start, end, strand) for each row."""
+        if rows is None:
+            rows = self.rows()
+        seqids = [self.names['seqid'][i] for i in self.columns['seqid'][rows].tolist()]
+        strands = [self.names['strand'][i] for i in self.columns['strand'][rows].tolist()]
+        return list(zip(seqids, self.columns['start'][rows].tolist(), self.columns['end'][rows].tolist(), strands))
+
+    def strings(self, column, rows):
+        """Return a list of the strings in a column for each row, gathering
+        only the bytes of those rows.
+        """
+        import numpy as np # only needed for GFF3Table
+
+        offsets = self.columns[column + '_offsets']
+        starts = offsets[rows]
+        lengths = offsets[rows + 1] - starts
+        bounds = np.cumsum(lengths)
+        if len(bounds) == 0:
+            return []
+        gather = np.arange(bounds[-1]) + np.repeat(starts - (bounds - lengths), lengths)
+        data = self.columns[column + '_bytes'][gather].tobytes()
+        bounds = [0] + bounds.tolist()
+        return [data[i:j].decode() for i, j in zip(bounds[:-1], bounds[1:])]
+
+    def take(self, rows):
+        """Return a list of the Features in 'rows' (an array of row numbers),
+        building them together.
+        """
+        col = self.columns
+        names = [[self.names[i][j] for j in col[i][rows].tolist()] for i in CACHE_COLUMNS]
+        seqids, sources, types, strands, phases = names
+        return [Feature(*i) for i in zip(seqids, sources, types, col['start'][rows].tolist(), col['end'][rows].tolist(),
+                                         self.strings('score', rows), strands, phases, self.strings('attr_string', rows))]
+
+    def features(self, types=None, rows=None):
+        """Yield a Feature for each row (of the given types, or in 'rows'),
+        building FEATURE_BATCH of them at a time.
+        """
+        if rows is None:
+            rows = self.rows(types)
+        for i in range(0, len(rows), FEATURE_BATCH):
+            for feature in self.take(rows[i:i+FEATURE_BATCH]):
+                yield feature
+
+
+class FeatureList(object):
+    """The Features in some rows of a GFF3Table, built in batches each time
+    the list is iterated over.
+
+    Attributes:
+        table: The GFF3Table.
+        rows: An array of row numbers.
+    """
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return self.table.features(rows=self.rows)
+
+
+def read_gff3_table(path, cache=False, region=None):
+    """Return the GFF3Table of a file, through the parsed-file cache if 'cache'
+    is True. A region is parsed through the tabix index instead, and isn't
+    cached.
+    """
+    if cache and region is None:
+        return GFF3Table.load(path)
+    return GFF3Table.parse(path, region)
+
+
+def read_gff3_cached(path, types=None, region=None):
+    """Like read_gff3(), but through the parsed-file cache. A region is read
+    through the tabix index instead.
+    """
+    if region is not None:
+        return read_gff3(path, types, region)
+    return GFF3Table.load(path).features(types)
@@ -0,0 +1,103 @@
+# Purpose: Shared performance metrics for the scripts. Records the wall time,
+#          CPU time, counts (reads decoded, features emitted) and peak memory of
+#          each stage of a run, and writes them to a JSON report.
+
+from __future__ import print_function
+import json, os, sys
+from contextlib import contextmanager
+from time import time
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+
+def cpu_time():
+    """Return the CPU time (user + system) used by this process and any child
+    processes that have finished.
+    """
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def peak_rss_mb():
+    """Return the peak resident set size of this process, or of the largest
+    finished child process, in MB.
+    """
+    if resource is None:
+        return None
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak / 1024.0 / 1024 # bytes
+    return peak / 1024.0 # kB
+
+
+class Metrics(object):
+    """Times each stage of a run and counts the reads decoded and features
+    emitted in it. Counts are added to the innermost stage being timed. Only
+    written out if a path is given.
+
+    Attributes:
+        path: The JSON file to write the report to (or None).
+        stages: The finished stages, in the order they finished.
+        current: The stage being timed (or None).
+        time_start: The time the object was created.
+        cpu_start: The CPU time when the object was created.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.stages = []
+        self.current = None
+        self.time_start = time()
+        self.cpu_start = cpu_time()
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage of the run: 'with metrics.stage('scan BAM'): ...'"""
+        stage = {'name': name, 'reads': 0, 'features': 0}
+        parent, self.current = self.current, stage
+        wall, cpu = time(), cpu_time()
+        try:
+            yield stage
+        finally:
+            stage['wall_time'] = time() - wall
+            stage['cpu_time'] = cpu_time() - cpu
+            stage['peak_rss_mb'] = peak_rss_mb()
+            self.current = parent
+            self.stages.append(stage)
+
+    def count(self, reads=0, features=0):
+        """Add to the reads decoded and features emitted in the current stage."""
+        if self.current is not None:
+            self.current['reads'] += reads
+            self.current['features'] += features
+
+    def report(self):
+        """Return the report as a dictionary."""
+        stages = []
+        for stage in self.stages:
+            stage = dict(stage)
+            stage['reads_per_second'] = stage['reads'] / stage['wall_time'] if stage['wall_time'] > 0 else None
+            stages.append(stage)
+        wall = time() - self.time_start
+        reads = sum(i['reads'] for i in self.stages)
+        return {'script': os.path.basename(sys.argv[0]),
+                'argv': sys.argv[1:],
+                'wall_time': wall,
+                'cpu_time': cpu_time() - self.cpu_start,
+                'peak_rss_mb': peak_rss_mb(),
+                'reads': reads,
+                'reads_per_second': reads / wall if wall > 0 else None,
+                'features': sum(i['features'] for i in self.stages),
+                'stages': stages}
+
+    def write(self):
+        """Write the report to 'path' as JSON (if a path was given)."""
+        if self.path is None:
+            return
+        with open(self.path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+            f.write('\n')
@@ -1,87 +1,383 @@
 #!/usr/local/bin/python3
 #Last updated: 31/7/2017
 
-import sys
+import argparse, heapq, os, sys, tempfile
+import numpy as np
 from collections import defaultdict
+from itertools import groupby
+from gff3 import FEATURE_BATCH, Feature, bgzip_gff3, read_gff3, read_gff3_cached, read_gff3_table, write_gff3
+from metrics import Metrics
+from profiling import Profiler
 
-def parse_attr(lines):
-    """Parse attributes column in format 'tag=value' and return a dictionary in
-    the form tag:values
+CHUNK_SIZE = 1000000 # number of lines sorted in memory at once when sorting a file
+
+metrics = Metrics() # timings and counts for each stage, written with --metrics
+profiler = Profiler() # CPU and memory profiles, written with --profile
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Merge features of the same type and position in one or more GFF3 files.')
+    parser.add_argument('files',
+                        type=str,
+                        nargs='+',
+                        help='one or more files in GFF3 format')
+    parser.add_argument('-s',
+                        '--stream',
+                        action='store_true',
+                        help='merge sorted files in constant memory (unsorted files are sorted first)')
+    parser.add_argument('-c',
+                        '--cache',
+                        action='store_true',
+                        help="cache the parsed files next to the input ('<file>.cache'), so later runs on unchanged files skip parsing")
+    parser.add_argument('--region',
+                        type=str,
+                        help="only merge the features in this region ('chrom:start-end'); the files must be bgzipped and tabix indexed")
+    parser.add_argument('-z',
+                        '--bgzip',
+                        type=str,
+                        metavar='FILE',
+                        help="write the output to FILE, compressed with bgzip and indexed with tabix ('FILE.gz' and 'FILE.gz.tbi')")
+    parser.add_argument('--metrics',
+                        type=str,
+                        metavar='FILE',
+                        help='write the time, features emitted and peak memory of each stage to FILE as JSON')
+    parser.add_argument('--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='profile the run and write a CPU profile and the top memory allocations to DIR')
+    args = parser.parse_args()
+
+    return args.files, args.stream, args.cache, args.region, args.bgzip, args.metrics, args.profile
+
+
+def parse_attr(features):
+    """Collect the attributes of features in format 'tag=value' and return a
+    dictionary in the form tag:values
     """
     attr_dict = defaultdict(set)
 
-    for line in lines:
-        attrs = line.split('\t')[8].strip().split(';')
-        for i in attrs:
-            tag, val = i.split('=', 1)
+    for feature in features:
+        for tag, val in feature.attributes.items():
             attr_dict[tag].add(val)
 
     return attr_dict
 
 
-def parse_GFF3(file_list):
-    """Parse a GFF3 format file and merge entries of the same type and
-    position.
+def merge_entries(features, counter):
+    """Merge features of the same type and position into one Feature."""
+    first = features[0]
+    # sum coverage; if none is specified, leave as "."
+    try:
+        new_cov = sum([int(i.score) for i in features])
+    except ValueError:
+        new_cov = '.'
+    # merge attributes
+    new_attr = []
+    attr_dict = parse_attr(features)
+    attr_dict['ID'] = [str(counter)] # for now, ID will just be a number
+    for attr in sorted(attr_dict):
+        i = sorted(attr_dict[attr])
+        if len(i) > 0:
+            j = attr + '=' + ','.join(i)
+            new_attr.append(j)
+    new_attr = ';'.join(new_attr)
+
+    return Feature(first.seqid, first.source, first.type, first.start, first.end,
+                   new_cov, first.strand, first.phase, new_attr)
+
+
+class MergedEntries(object):
+    """The features of one or more GFF3 files grouped into entries of the same
+    type and position, as arrays over the rows of a GFF3Table per file. The
+    entries are numbered in the order they first appear, and the merged
+    Features are only built as they're written.
+
+    Attributes:
+        tables: A GFF3Table for each file.
+        offsets: The first feature number of each file (and the total).
+        order: The feature numbers, grouped by entry, in order of appearance
+            within each entry.
+        member_starts: The first index into 'order' of each entry.
+        member_ends: The index into 'order' after the last of each entry.
+        seqid_names: The chromosome names, in order of their codes.
+        strand_names: The strand names, in order of their codes.
+        seqids: The chromosome of each entry, as a code.
+        strands: The strand of each entry, as a code.
+        starts: The start of each entry.
+        ends: The end of each entry.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.offsets = np.cumsum([0] + [len(i) for i in tables])
+        names = {'seqid':[], 'type':[], 'strand':[]}
+        codes = {i:{} for i in names}
+        columns = {i:[] for i in ('seqid', 'type', 'strand', 'start', 'end')}
+        for table in tables:
+            for i in names: # use the same codes for every file
+                mapping = [codes[i].setdefault(j, len(codes[i])) for j in table.names[i]]
+                columns[i].append(np.array(mapping, dtype=np.int32)[table.columns[i]])
+            for i in ('start', 'end'):
+                columns[i].append(table.columns[i])
+        for i in names:
+            names[i] = sorted(codes[i], key=codes[i].get)
+        self.seqid_names, self.strand_names = names['seqid'], names['strand']
+        columns = {i:np.concatenate(columns[i]) for i in columns}
+
+        # a stable sort keeps the features of each entry in order of appearance
+        keys = [columns[i] for i in ('strand', 'end', 'start', 'type', 'seqid')]
+        self.order = np.lexsort(keys)
+        same = np.zeros(len(self.order), dtype=bool)
+        same[1:] = True
+        for key in keys:
+            key = key[self.order]
+            same[1:] &= key[1:] == key[:-1]
+        member_starts = np.flatnonzero(~same)
+        member_ends = np.append(member_starts[1:], len(self.order))
+
+        # number the entries in order of appearance
+        firsts = self.order[member_starts]
+        appearance = np.argsort(firsts, kind='stable')
+        self.member_starts = member_starts[appearance]
+        self.member_ends = member_ends[appearance]
+        for i in ('seqid', 'strand', 'start', 'end'):
+            setattr(self, i + 's', columns[i][firsts[appearance]])
+
+    def __len__(self):
+        return len(self.member_starts)
+
+    def features(self, entries):
+        """Yield the merged Feature of each entry (an array of entry numbers),
+        building the features FEATURE_BATCH entries at a time.
+        """
+        for i in range(0, len(entries), FEATURE_BATCH):
+            batch = entries[i:i+FEATURE_BATCH]
+            lengths = self.member_ends[batch] - self.member_starts[batch]
+            bounds = np.cumsum(lengths)
+            members = self.order[np.arange(bounds[-1]) + np.repeat(self.member_starts[batch] - (bounds - lengths), lengths)]
+            files = np.searchsorted(self.offsets, members, 'right') - 1
+            features = [None] * len(members)
+            for n, table in enumerate(self.tables):
+                selected = np.flatnonzero(files == n)
+                for j, feature in zip(selected.tolist(), table.take(members[selected] - self.offsets[n])):
+                    features[j] = feature
+            bounds = [0] + bounds.tolist()
+            for entry, start, end in zip(batch.tolist(), bounds[:-1], bounds[1:]):
+                yield merge_entries(features[start:end], entry + 1) # for now, ID will just be a number
+
+
+def parse_GFF3(file_list, cache=False, region=None):
+    """Parse GFF3 format files and group entries of the same type and
+    position. The files are kept as columns, and the merged entries are built
+    as they're iterated over. With 'cache', the files are loaded through the
+    parsed-file cache. With 'region', only the features overlapping it are
+    read.
     """
     header = ['##gff-version 3']
-    entries = defaultdict(list)
-    new_entries = []
+    tables = []
+    for n, infile in enumerate(file_list):
+        header.append('##File {} = {}'.format(n+1, infile))
+        tables.append(read_gff3_table(infile, cache, region))
+
+    return header, MergedEntries(tables)
 
-    # group entries by feature position
+
+def chromosome_key(chrom):
+    """Sort key for chromosomes that no input file puts in order.
+    Note: C. elegans uses roman numerals for chromosomes names.
+    """
+    numerals = {'I':1, 'II':2, 'III':3, 'IV':4, 'V':5, 'X':10, 'MtDNA':11}
+    if chrom in numerals:
+        return 0, numerals[chrom], ''
+    return 1, 0, chrom
+
+
+def read_features(path, rank, cache=False, region=None):
+    """Yield the position key, entry and Feature of each feature in a GFF3
+    file (overlapping 'region'), through the parsed-file cache if 'cache' is
+    True. The position key orders chromosomes by 'rank' (chromosome:number).
+    """
+    reader = read_gff3_cached if cache else read_gff3
+    for feature in reader(path, region=region):
+        entry = feature.seqid, feature.type, feature.start, feature.end, feature.strand
+        yield (rank[feature.seqid], feature.start), entry, feature
+
+
+def chromosome_order(path, cache=False, region=None):
+    """Return the chromosomes of a GFF3 file in the order they first appear,
+    and whether the file is sorted: the features of each chromosome together
+    and sorted by start. Any order of chromosomes counts as sorted.
+    """
+    reader = read_gff3_cached if cache else read_gff3
+    order = []
+    seen = set()
+    is_sorted = True
+    prev_chrom, prev_start = None, None
+    for feature in reader(path, region=region):
+        if feature.seqid != prev_chrom:
+            if feature.seqid in seen:
+                is_sorted = False
+            else:
+                seen.add(feature.seqid)
+                order.append(feature.seqid)
+            prev_chrom = feature.seqid
+        elif feature.start < prev_start:
+            is_sorted = False
+        prev_start = feature.start
+
+    return order, is_sorted
+
+
+def merge_orders(orders):
+    """Combine the chromosome orders of the sorted files into one order that
+    every file agrees with, taking each file in turn. Returns the combined
+    order (followed by the chromosomes only found in unsorted files) and
+    whether each file agrees with it.
+    """
+    combined = []
+    agrees = []
+    for order, is_sorted in orders:
+        position = {chrom:n for n, chrom in enumerate(combined)}
+        known = [position[i] for i in order if i in position]
+        if not is_sorted or known != sorted(known):
+            agrees.append(False)
+            continue
+        agrees.append(True)
+        # put new chromosomes right after the one before them in this file
+        n = 0
+        for chrom in order:
+            if chrom in position:
+                n = combined.index(chrom) + 1
+            else:
+                combined.insert(n, chrom)
+                n += 1
+
+    extra = set(chrom for order, _ in orders for chrom in order) - set(combined)
+    return combined + sorted(extra, key=chromosome_key), agrees
+
+
+def write_features(features):
+    """Write features to a temporary file and return its path."""
+    fd, path = tempfile.mkstemp(suffix='.gff3')
+    with os.fdopen(fd, 'w') as f:
+        write_gff3(features, f, header=())
+
+    return path
+
+
+def sort_file(path, rank, chunk_size=CHUNK_SIZE, region=None):
+    """Sort a GFF3 file (the features overlapping 'region') by position, with
+    chromosomes ordered by 'rank', in chunks of 'chunk_size' lines, merge the
+    chunks and return the path of the sorted temporary file.
+    """
+    chunks = []
+    features = read_features(path, rank, region=region)
+    while True:
+        chunk = [i for _, i in zip(range(chunk_size), features)]
+        if len(chunk) == 0:
+            break
+        chunk.sort(key=lambda x: x[0])
+        chunks.append(write_features(i[2] for i in chunk))
+
+    merged = heapq.merge(*[read_features(i, rank) for i in chunks], key=lambda x: x[0])
+    sorted_path = write_features(i[2] for i in merged)
+    for i in chunks:
+        os.remove(i)
+
+    return sorted_path
+
+
+def stream_GFF3(file_list, cache=False, region=None):
+    """Merge entries of the same type and position from GFF3 files sorted by
+    position, with a k-way merge of the files. Only features sharing a start
+    position are held in memory. A file counts as sorted if the features of
+    each chromosome are together and sorted by start, with the chromosomes in
+    any order that agrees with the files before it (e.g. the order of a BAM
+    header); other files are sorted first, in the combined chromosome order.
+    Returns the header and an iterator over the merged entries, in order.
+    With 'cache', sorted input files are read through the parsed-file cache.
+    With 'region', only the features overlapping it are read.
+    """
+    header = ['##gff-version 3']
+    paths = []
+    tmp_paths = []
+
+    orders = []
     for n, infile in enumerate(file_list):
         header.append('##File {} = {}'.format(n+1, infile))
-        with open(infile, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line[0] != '#':
-                    i = line.split('\t')
-                    entry = i[0], i[2], int(i[3]), int(i[4]), i[6]
-                    entries[entry].append(line)
-
-    # merge GFF3 attributes
-    counter = 1
-    for pos, lines in entries.items():
-        new_line = lines[0].split('\t')[:8]
-        # sum coverage; if none is specified, leave as "."
-        try:
-            new_cov = sum([int(i.split('\t')[5]) for i in lines])
-        except ValueError:
-            new_cov = '.'
-        new_line[5] = new_cov
-        # merge attributes
-        new_attr = []
-        attr_dict = parse_attr(lines)
-        attr_dict['ID'] = [str(counter)] # for now, ID will just be a number
-        for attr in sorted(attr_dict):
-            i = sorted(attr_dict[attr])
-            if len(i) > 0:
-                j = attr + '=' + ','.join(i)
-                new_attr.append(j)
-        new_attr = ';'.join(new_attr)
-        new_line.append(new_attr)
-        new_entries.append(new_line)
-        counter += 1
-
-    return header, new_entries
+        orders.append(chromosome_order(infile, cache, region))
+    order, agrees = merge_orders(orders)
+    rank = {chrom:n for n, chrom in enumerate(order)}
+
+    for infile, (_, is_sorted), agree in zip(file_list, orders, agrees):
+        if agree:
+            paths.append(infile)
+            continue
+        if not is_sorted:
+            reason = "its chromosomes' features aren't together and sorted by start"
+        else:
+            reason = 'its chromosomes are in a different order to the files before it'
+        print('{} is not sorted ({}), sorting it first...'.format(infile, reason), file=sys.stderr)
+        tmp_paths.append(sort_file(infile, rank, region=region))
+        paths.append(tmp_paths[-1])
+
+    def merged_entries():
+        counter = 1
+        merged = heapq.merge(*[read_features(i, rank, cache, region) if i not in tmp_paths else read_features(i, rank) for i in paths],
+                             key=lambda x: x[0])
+        for _, group in groupby(merged, key=lambda x: x[0]):
+            entries = defaultdict(list)
+            for _, entry, feature in group:
+                entries[entry].append(feature)
+            for entry in sorted(entries, key=lambda x: (x[3], x[4], x[1])):
+                yield merge_entries(entries[entry], counter)
+                counter += 1
+        for i in tmp_paths:
+            os.remove(i)
+
+    return header, merged_entries()
 
 
 def sort_features(entries):
-    """Sort GFF3 formatted entries by chromosome then start position.
+    """Sort merged entries by chromosome then start position, end and strand,
+    and return an iterator over their Features. Entries at the same position
+    stay in order of appearance.
     Note: C. elegans uses roman numerals for chromosomes names.
     """
     numerals = {'I':1, 'II':2, 'III':3, 'IV':4, 'V':5, 'X':10, 'MtDNA':11}
     try:
-        return sorted(entries, key = lambda x: (numerals[x[0]], int(x[3]), int(x[4]), x[6]))
+        chrom_ranks = [numerals[i] for i in entries.seqid_names]
     except KeyError:
-        return sorted(entries, key = lambda x: (x[0], int(x[3]), int(x[4]), x[6]))
+        chrom_ranks = name_ranks(entries.seqid_names)
+    chroms = np.array(chrom_ranks, dtype=np.int64)[entries.seqids]
+    strands = np.array(name_ranks(entries.strand_names), dtype=np.int64)[entries.strands]
+    return entries.features(np.lexsort((strands, entries.ends, entries.starts, chroms)))
+
+
+def name_ranks(names):
+    """Return the position of each name when the names are sorted."""
+    position = {name:n for n, name in enumerate(sorted(names))}
+    return [position[i] for i in names]
 
 
 if __name__ == '__main__':
-    file_list = sys.argv[1:] # files specified as arguments
-    header, entries = parse_GFF3(file_list)
-    entries_sorted = sort_features(entries)
-
-    for i in header:
-        print(i)
-    for i in entries_sorted:
-        print('\t'.join(map(str, i)))
+    file_list, stream, cache, region, bgzip_path, metrics.path, profile_dir = parse_commandline_arguments()
+    profiler.start(profile_dir)
+    if stream:
+        with metrics.stage('sort inputs'):
+            header, entries_sorted = stream_GFF3(file_list, cache, region)
+    else:
+        with metrics.stage('parse inputs'):
+            header, entries = parse_GFF3(file_list, cache, region)
+        with metrics.stage('sort'):
+            entries_sorted = sort_features(entries)
+
+    # when streaming, the files are merged as the output is written
+    with metrics.stage('merge and write' if stream else 'write'):
+        if bgzip_path is None:
+            metrics.count(features=write_gff3(entries_sorted, header=header))
+        else:
+            with open(bgzip_path, 'w') as f:
+                metrics.count(features=write_gff3(entries_sorted, f, header=header))
+            print('Wrote output to {}'.format(bgzip_gff3(bgzip_path)), file=sys.stderr)
+    profiler.stop()
+    metrics.write()
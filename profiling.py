@@ -0,0 +1,126 @@
+# Purpose: Shared profiling hooks for the scripts (--profile DIR). Captures a
+#          cProfile dump, a tracemalloc snapshot of the top allocations and a
+#          sampled histogram of the time spent on each read in the main loops.
+#          Nothing is recorded, and the loops are left untouched, unless
+#          profiling has been started.
+
+from __future__ import print_function, division
+import cProfile, json, os, pstats, sys, tracemalloc
+from time import perf_counter
+
+SAMPLE_EVERY = 100 # time one in this many reads in each main loop
+TOP_FUNCTIONS = 50 # number of functions listed in the CPU profile summary
+TOP_ALLOCATIONS = 50 # number of source lines listed in the allocation summary
+
+class Profiler(object):
+    """Profile a run and write the results to a directory:
+        cpu.prof: the cProfile dump (open with pstats or snakeviz)
+        cpu.txt: the functions with the most cumulative time
+        allocations.txt: the source lines holding the most memory at the end
+        read_times.json: a histogram of the time per read in each main loop,
+                         with power-of-two buckets in microseconds
+    Only the main process is profiled; worker processes stop the profiling
+    they inherit with detach().
+
+    Attributes:
+        path: The output directory (None if profiling hasn't been started).
+        profile: The running cProfile.Profile.
+        histograms: The number of sampled reads in each bucket, for each loop.
+        totals: The total sampled time (s) for each loop.
+        counts: The number of reads seen by each loop, so sampling carries on
+                across calls.
+        sample_every: Time one in this many reads.
+    """
+
+    def __init__(self, sample_every=SAMPLE_EVERY):
+        self.path = None
+        self.profile = None
+        self.histograms = {}
+        self.totals = {}
+        self.counts = {}
+        self.sample_every = sample_every
+
+    def start(self, path):
+        """Start profiling, if 'path' isn't None."""
+        if path is None:
+            return
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        tracemalloc.start()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def detach(self):
+        """Pool initializer: stop the profiling that a forked worker process
+        inherits from the main process, without writing any results. From
+        Python 3.12, cProfile uses sys.monitoring rather than sys.setprofile(),
+        so the inherited profile is disabled as well.
+        """
+        if self.profile is not None:
+            self.profile.disable()
+        sys.setprofile(None)
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.path = None
+        self.profile = None
+
+    def sample(self, name, reads):
+        """Return the reads of a main loop unchanged, or, while profiling, a
+        generator that also times the loop body for one in 'sample_every' reads.
+        """
+        if self.path is None:
+            return reads
+        return self.sampled(name, reads)
+
+    def sampled(self, name, reads):
+        histogram = self.histograms.setdefault(name, {})
+        self.totals.setdefault(name, 0.0)
+        n = self.counts.get(name, 0)
+        try:
+            for read in reads:
+                n += 1
+                if n % self.sample_every != 0:
+                    yield read
+                    continue
+                start = perf_counter()
+                yield read
+                elapsed = perf_counter() - start
+                bucket = int(elapsed * 1e6).bit_length() # [2**(bucket-1), 2**bucket) us
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+                self.totals[name] += elapsed
+        finally:
+            self.counts[name] = n
+
+    def stop(self):
+        """Stop profiling and write the results."""
+        if self.path is None:
+            return
+        self.profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+        self.profile.dump_stats(os.path.join(self.path, 'cpu.prof'))
+        with open(os.path.join(self.path, 'cpu.txt'), 'w') as f:
+            pstats.Stats(self.profile, stream=f).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        with open(os.path.join(self.path, 'allocations.txt'), 'w') as f:
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                print(stat, file=f)
+        with open(os.path.join(self.path, 'read_times.json'), 'w') as f:
+            json.dump(self.read_times(), f, indent=2)
+            f.write('\n')
+        self.path = None
+
+    def read_times(self):
+        """Return the sampled time per read of each main loop."""
+        report = {}
+        for name, histogram in self.histograms.items():
+            samples = sum(histogram.values())
+            report[name] = {
+                'reads': self.counts.get(name, 0),
+                'sample_every': self.sample_every,
+                'samples': samples,
+                'mean_us': self.totals[name] * 1e6 / samples if samples > 0 else None,
+                'histogram': [{'min_us': 2 ** (i - 1) if i > 0 else 0, 'max_us': 2 ** i, 'count': histogram[i]}
+                              for i in sorted(histogram)]}
+        return report
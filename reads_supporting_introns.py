@@ -3,10 +3,25 @@
 # Author: Matt Douglas
 
 from __future__ import print_function, division
-import argparse, re, os, sys, pysam
-from collections import defaultdict
+import argparse, re, os, sqlite3, sys, pysam
+from bisect import bisect_left
+from collections import defaultdict, OrderedDict
 from itertools import chain
+from multiprocessing import Pool
 from time import time
+from cigar import parse_CIGAR
+from gff3 import read_gff3
+from metrics import Metrics
+from profiling import Profiler
+from sorting import MERGE_FILES, merge_runs, new_run, reduce_runs, remove_runs, sort_key
+
+SEEK_COST = 500 # estimated cost of one random seek, in alignments decoded
+SAMPLE_SIZE = 10000 # number of alignments sampled to estimate the read span
+BUFFER_SIZE = 100000 # number of alignments held in memory before sorting them to disk
+MAX_OPEN_FILES = 512 # maximum number of output files open at once
+
+metrics = Metrics() # timings and counts for each stage, written with --metrics
+profiler = Profiler() # CPU, memory and per-read profiles, written with --profile
 
 class Progress(object):
     """A timer to monitor the number of lines read, and number of supporting
@@ -39,6 +54,333 @@ class Progress(object):
         return (time() - self.time_start) / 60
 
 
+class IntronIndex(object):
+    """An index of the introns to search for. Exact matches are looked up in a
+    hashed set; when a tolerance is given, each chromosome also gets a list of
+    introns sorted by start position that is searched by bisection.
+
+    Attributes:
+        tolerance: Maximum distance (bp) between the start and end positions of
+                   a junction and an intron for them to match.
+        exact: A set of (chromosome, start, end) tuples.
+        starts: Sorted start positions of the introns on each chromosome.
+        introns: The introns on each chromosome, in the same order as 'starts'.
+    """
+
+    def __init__(self, parsed_introns, tolerance=0):
+        """Return an index of the introns."""
+        self.tolerance = tolerance
+        self.exact = set(parsed_introns)
+        self.starts = {}
+        self.introns = {}
+        if tolerance > 0:
+            by_chrom = defaultdict(list)
+            for intron in self.exact:
+                by_chrom[intron[0]].append(intron)
+            for chrom, introns in by_chrom.items():
+                introns.sort(key=lambda x: (x[1], x[2]))
+                self.introns[chrom] = introns
+                self.starts[chrom] = [i[1] for i in introns]
+
+    def __len__(self):
+        return len(self.exact)
+
+    def match(self, chrom, start, end):
+        """Return a list of the introns matching a junction."""
+        if self.tolerance == 0:
+            intron = chrom, start, end
+            return [intron] if intron in self.exact else []
+
+        matches = []
+        starts = self.starts.get(chrom)
+        if starts is None:
+            return matches
+        introns = self.introns[chrom]
+        for n in range(bisect_left(starts, start - self.tolerance), len(starts)):
+            if starts[n] > start + self.tolerance:
+                break
+            if abs(introns[n][2] - end) <= self.tolerance:
+                matches.append(introns[n])
+
+        return matches
+
+
+class ReadNameIndex(object):
+    """A persistent index of read names to the virtual file offsets of their
+    alignments, stored as an SQLite database next to the BAM index. The index
+    is rebuilt whenever the size or modification time of the BAM file changes.
+
+    Attributes:
+        bam_path: The path of the indexed BAM file.
+        path: The path of the read name index.
+        db: A connection to the read name index.
+    """
+
+    def __init__(self, bam_path):
+        """Open the read name index of a BAM file, building it if needed."""
+        self.bam_path = bam_path
+        self.path = bam_path + '.qni'
+        if not self.is_current():
+            self.build()
+        self.db = sqlite3.connect(self.path)
+
+    def identity(self):
+        """Return the size and modification time of the BAM file."""
+        stat = os.stat(self.bam_path)
+        return stat.st_size, stat.st_mtime
+
+    def is_current(self):
+        """Return True if the index exists and matches the BAM file."""
+        if not os.path.exists(self.path):
+            return False
+        db = sqlite3.connect(self.path)
+        try:
+            row = db.execute('SELECT size, mtime FROM meta').fetchone()
+        except sqlite3.DatabaseError:
+            row = None
+        finally:
+            db.close()
+
+        return row is not None and tuple(row) == self.identity()
+
+    def build(self):
+        """Read through the BAM file once and record the offset of every
+        alignment.
+        """
+        eprint(' Building read name index: {}'.format(self.path))
+        identity = self.identity()
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        db = sqlite3.connect(tmp_path)
+        db.execute('CREATE TABLE meta (size INTEGER, mtime REAL)')
+        db.execute('CREATE TABLE reads (qname TEXT, offset INTEGER)')
+        with pysam.AlignmentFile(self.bam_path, 'rb') as bamfile:
+            db.executemany('INSERT INTO reads VALUES (?, ?)', self.offsets(bamfile))
+        db.execute('CREATE INDEX qname_index ON reads (qname)')
+        db.execute('INSERT INTO meta VALUES (?, ?)', identity)
+        db.commit()
+        db.close()
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def offsets(bamfile):
+        """Yield the read name and virtual file offset of each alignment."""
+        offset = bamfile.tell()
+        for line in bamfile:
+            yield line.qname, offset
+            offset = bamfile.tell()
+
+    def fetch(self, qnames):
+        """Yield every alignment of the given reads, in file order."""
+        offsets = set()
+        for qname in qnames:
+            for row in self.db.execute('SELECT offset FROM reads WHERE qname = ?', (qname,)):
+                offsets.add(row[0])
+
+        with pysam.AlignmentFile(self.bam_path, 'rb') as bamfile:
+            for offset in sorted(offsets):
+                bamfile.seek(offset)
+                yield next(bamfile)
+
+    def close(self):
+        self.db.close()
+
+
+class SortedAlignmentWriter(object):
+    """Write alignments to a coordinate-sorted SAM/BAM file, skipping any
+    alignment that has already been written. Alignments are held in a buffer of
+    at most 'buffer_size' alignments, which is sorted and written to a temporary
+    BAM file whenever it fills up. The temporary files are merged, at most
+    MERGE_FILES at a time, when the writer is closed, dropping duplicates as
+    they meet in the final merge, and BAM output is indexed.
+
+    Attributes:
+        samfile: The input file (used as a template for the header).
+        output_path: The path of the output file.
+        buffer_size: Maximum number of alignments held in memory.
+        buffer: Alignments waiting to be sorted.
+        chunks: Paths of the sorted temporary files.
+        count: The number of alignments written (set when the writer is closed).
+    """
+
+    def __init__(self, samfile, output_path, buffer_size=BUFFER_SIZE):
+        """Return a writer for 'output_path'."""
+        self.samfile = samfile
+        self.output_path = output_path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.chunks = []
+        self.count = 0
+
+    @staticmethod
+    def key(line):
+        """Return a compact key identifying an alignment."""
+        return line.qname, line.flag, line.reference_id, line.pos, hash(line.cigarstring)
+
+    @classmethod
+    def unique(cls, lines):
+        """Yield coordinate-sorted alignments, skipping duplicates. Duplicates
+        share a position, so only the keys at the current position are kept.
+        """
+        position, keys = None, set()
+        for line in lines:
+            line_position = sort_key(line)
+            if line_position != position:
+                position, keys = line_position, set()
+            key = cls.key(line)
+            if key not in keys:
+                keys.add(key)
+                yield line
+
+    def write(self, line):
+        """Add an alignment to the output."""
+        self.buffer.append(line)
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Sort the buffer and write it to a temporary file."""
+        chunk_path, chunk = new_run(self.output_path, self.samfile.header)
+        self.chunks.append(chunk_path)
+        with chunk:
+            for line in sorted(self.buffer, key=sort_key):
+                chunk.write(line)
+        self.buffer = []
+
+    def close(self):
+        """Merge the sorted alignments into the output file."""
+        try:
+            lines = sorted(self.buffer, key=sort_key)
+            self.buffer = []
+            # merge in batches, so only MERGE_FILES chunks are open at once
+            if len(self.chunks) > MERGE_FILES:
+                eprint(' Merging {:,} sorted chunks...'.format(len(self.chunks)))
+            reduce_runs(self.chunks, self.output_path, self.samfile.header)
+
+            #  output file is either SAM or BAM, depending the output_path extension
+            with pysam.AlignmentFile(self.output_path, optype(self.output_path, 'w'), template=self.samfile) as outfile:
+                for line in self.unique(merge_runs(self.chunks, lines)):
+                    outfile.write(line)
+                    self.count += 1
+        finally:
+            remove_runs(self.chunks)
+
+        if optype(self.output_path) == 'rb':
+            pysam.index(self.output_path)
+
+
+class IntronFileWriter(object):
+    """Write the alignments supporting each intron to a separate file as soon
+    as they are found. At most 'max_open' files are kept open at once (limited
+    by the number of file descriptors available); the least recently used file
+    is closed when another needs to be opened. A file that is opened again is
+    written to a new part, and the parts are merged when the writer is closed.
+    Duplicates are skipped as they are written while a file stays in order; a
+    file written out of order is sorted, and its duplicates dropped, when the
+    writer is closed. BAM files are indexed.
+
+    Attributes:
+        samfile: The input file (used as a template for the header).
+        ext: The extension of the output files ('sam' or 'bam').
+        max_open: Maximum number of files open at once.
+        handles: Open files, from least to most recently used.
+        parts: The paths of the parts written for each output file.
+        unsorted: Output files with alignments written out of order.
+        last_key: Sort key of the last alignment written to each output file.
+        keys: Keys of the alignments written at that position, for each file.
+        counts: The number of alignments written to each output file.
+    """
+
+    def __init__(self, samfile, ext='sam', max_open=MAX_OPEN_FILES):
+        """Return a writer for files of type 'ext'."""
+        self.samfile = samfile
+        self.ext = ext
+        self.max_open = max(1, min(max_open, fd_limit() - 32))
+        self.handles = OrderedDict()
+        self.parts = OrderedDict()
+        self.unsorted = set()
+        self.last_key = {}
+        self.keys = {}
+        self.counts = defaultdict(int)
+
+    def path(self, intron):
+        return '_'.join(map(str, intron)) + '.' + self.ext
+
+    def handle(self, path):
+        """Return an open file for 'path', closing the least recently used file
+        if too many are open.
+        """
+        if path in self.handles:
+            self.handles[path] = self.handles.pop(path)
+            return self.handles[path]
+
+        if len(self.handles) >= self.max_open:
+            _, oldest = self.handles.popitem(last=False)
+            oldest.close()
+        parts = self.parts.setdefault(path, [])
+        part_path = path if len(parts) == 0 else '{}.part{}.{}'.format(path, len(parts), self.ext)
+        parts.append(part_path)
+        self.handles[path] = pysam.AlignmentFile(part_path, optype(part_path, 'w'), template=self.samfile)
+
+        return self.handles[path]
+
+    def write(self, intron, line):
+        """Write an alignment to the file for 'intron', unless it's a duplicate."""
+        path = self.path(intron)
+        key = SortedAlignmentWriter.key(line)
+        line_key = sort_key(line)
+        if line_key == self.last_key.get(path):
+            if key in self.keys[path]:
+                return
+            self.keys[path].add(key)
+        else:
+            if path in self.last_key and line_key < self.last_key[path]:
+                self.unsorted.add(path)
+            self.last_key[path] = line_key
+            self.keys[path] = {key}
+        self.counts[path] += 1
+        self.handle(path).write(line)
+
+    def count(self, intron):
+        """Return the number of alignments written for 'intron'."""
+        return self.counts.get(self.path(intron), 0)
+
+    def sort_unique(self, path):
+        """Sort a file written out of order and drop its duplicates."""
+        sorted_path = path + '.sorted.' + self.ext
+        pysam.sort('-O', self.ext, '-o', sorted_path, path)
+        self.counts[path] = 0
+        with pysam.AlignmentFile(sorted_path, optype(sorted_path, 'r'), check_sq=False) as infile, \
+             pysam.AlignmentFile(path, optype(path, 'w'), template=infile) as outfile:
+            for line in SortedAlignmentWriter.unique(infile.fetch(until_eof=True)):
+                outfile.write(line)
+                self.counts[path] += 1
+        os.remove(sorted_path)
+
+    def close(self):
+        """Close all files, merging parts and indexing BAM files."""
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+        for path, parts in self.parts.items():
+            if len(parts) > 1:
+                merged_path = path + '.merged.' + self.ext
+                with pysam.AlignmentFile(merged_path, optype(path, 'w'), template=self.samfile) as outfile:
+                    for part_path in parts:
+                        with pysam.AlignmentFile(part_path, optype(part_path, 'r'), check_sq=False) as part:
+                            for line in part.fetch(until_eof=True):
+                                outfile.write(line)
+                        os.remove(part_path)
+                os.replace(merged_path, path)
+            if path in self.unsorted:
+                self.sort_unique(path)
+            if self.ext == 'bam':
+                pysam.index(path)
+
+
 #####################
 # Utility functions #
 #####################
@@ -63,6 +405,15 @@ def format_intron(intron):
     return intron[0] + ':' + str(intron[1]) + '-' + str(intron[2])
 
 
+def fd_limit():
+    """Return the maximum number of open files allowed for this process."""
+    try:
+        import resource
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ImportError, ValueError):
+        return MAX_OPEN_FILES
+
+
 def count_lines(samfile):
     """Count the number of lines in a BAM file."""
     count = 0
@@ -91,13 +442,12 @@ def parse_intron(intron_coord):
     return chrom, int(start), int(end)
 
 
-def parse_GFF3(GFF3_file):
-    """Parse a GFF3 file and return all intron coordinates."""
-    for line in GFF3_file:
-        if line[0] != '#':
-            col = line.split('\t')
-            chrom, start, end = col[0], int(col[3]), int(col[4])
-            yield chrom, start, end
+def parse_GFF3(GFF3_file, region=None):
+    """Parse a GFF3 file and return all intron coordinates (overlapping
+    'region', if given).
+    """
+    for feature in read_gff3(GFF3_file, region=region):
+        yield feature.seqid, feature.start, feature.end
 
 
 def parse_TSV(TSV_file):
@@ -122,10 +472,18 @@ def parse_commandline_arguments():
     parser.add_argument('-a', type=str, nargs='?', help='a SAM or BAM file')
     parser.add_argument('-i', type=str, nargs='+', help="one or more introns on the command line in the format 'I:1234..1345'")
     parser.add_argument('-g', type=str, nargs='?', help='a GFF3 file of introns to search for')
+    parser.add_argument('--region', type=str, help="only read the introns in the GFF3 file in this region ('chrom:start-end'); the file must be bgzipped and tabix indexed")
     parser.add_argument('-t', type=str, nargs='?', help='a tab-seperated file of introns to search for')
+    parser.add_argument('--tolerance', type=int, default=0, help='match junctions within this many bp of an intron (default=0)')
     parser.add_argument('-r', action='store_true', help='report all alternative alignments, and paired alignments, for supporting reads')
     parser.add_argument('-o', type=str, nargs='?', help='output file (if not specified, each intron will have a seperate file)')
+    parser.add_argument('-b', action='store_true', help='write a sorted and indexed BAM file for each intron, instead of a SAM file')
+    parser.add_argument('--read-span', type=int, help='merge search regions closer than this many bp (default: the largest span of a sample of alignments)')
+    parser.add_argument('--plan', type=str, choices=('auto', 'regions', 'scan'), default='auto', help="fetch each region, scan each chromosome, or choose automatically (default='auto')")
+    parser.add_argument('-p', '--processes', type=int, default=1, help='number of worker processes used to search regions (default=1)')
     parser.add_argument('-q', action='store_true', help='quiet mode (do not print progress)')
+    parser.add_argument('--metrics', type=str, metavar='FILE', help='write the time, reads decoded, features emitted and peak memory of each stage to FILE as JSON')
+    parser.add_argument('--profile', type=str, metavar='DIR', help='profile the main process and write a CPU profile, the top memory allocations and a sampled time-per-read histogram to DIR')
     args = parser.parse_args()
 
     # parse each intron specifed in the command line (if any)
@@ -135,9 +493,8 @@ def parse_commandline_arguments():
 
     # parse each intron listed in a GFF3 file (if any)
     if args.g is not None:
-        with open(args.g, 'r') as f:
-            for i in parse_GFF3(f):
-                parsed_introns.append(i)
+        for i in parse_GFF3(args.g, args.region):
+            parsed_introns.append(i)
 
     # parse each intron listed in a TSV file (if any)
     if args.t is not None:
@@ -150,24 +507,39 @@ def parse_commandline_arguments():
         parser.print_help()
         sys.exit(1)
 
-    return parsed_introns, args.a, args.r, args.o, args.q
+    return parsed_introns, args.a, args.r, args.o, args.b, args.q, args.tolerance, args.processes, args.plan, args.read_span, args.metrics, args.profile
 
 
 #######################################
 # Functions for doing the actual work #
 #######################################
-def regions_to_search(parsed_introns, read_length=150):
-    """Return a set of non-overlapping regions to search on each chromosome."""
+def sample_read_span(samfile, sample_size=SAMPLE_SIZE, default=150):
+    """Return the largest reference span of the first 'sample_size' mapped
+    alignments in the file (or 'default' if none are mapped).
+    """
+    spans = [line.reference_end - line.reference_start
+             for line in samfile.head(sample_size) if not line.is_unmapped]
+
+    return max(spans) if len(spans) > 0 else default
+
+
+def regions_to_search(parsed_introns, read_span=150, tolerance=0):
+    """Return a set of non-overlapping regions to search on each chromosome.
+    A supporting read must overlap the intron itself, so each region only
+    covers the intron (plus the matching tolerance), in 0-based, half-open
+    coordinates. Regions closer together than one read span are merged, since
+    the reads between them would otherwise be read twice.
+    """
     flatten = chain.from_iterable
     data = defaultdict(list)
 
     # process by chromosome
     for i in parsed_introns:
-        data[i[0]].append([i[1], i[2]])
+        data[i[0]].append([i[1] - 1 - tolerance, i[2] + tolerance])
 
     # find overlapping regions on each chromosome
     for chrom, ranges in data.items():
-        ranges = sorted(flatten(((start, 1), (end+read_length, -1)) for start, end in ranges))
+        ranges = sorted(flatten(((start, 1), (end+read_span, -1)) for start, end in ranges))
 
         c, x = 0, 0
         for value, label in ranges:
@@ -175,79 +547,142 @@ def regions_to_search(parsed_introns, read_length=150):
                 x = value
             c += label
             if c == 0:
-                yield chrom, x-read_length, value
-
-
-def parse_CIGAR(chrom, pos, cigar):
-    """Get the pos, end, and size of any introns from the CIGAR string.
-    if(  cigar_type == 0): #match
-    elif(cigar_type == 1): #insertions
-    elif(cigar_type == 2): #deletion
-    elif(cigar_type == 3): #skip
-    elif(cigar_type == 4): #soft clipping
-    elif(cigar_type == 5): #hard clipping
-    elif(cigar_type == 6): #padding
+                yield chrom, max(x, 0), value-read_span
+
+
+def plan_search(samfile, regions, plan='auto'):
+    """Decide whether to fetch each region, or to scan every chromosome with a
+    region on it, using the read density of each chromosome from the BAM index.
+    The cost of each plan is the estimated number of alignments decoded, plus
+    SEEK_COST per random seek. Returns the regions to search.
+    """
+    mapped = {i.contig:i.mapped for i in samfile.get_index_statistics()}
+    lengths = dict(zip(samfile.references, samfile.lengths))
+    chroms = set(chrom for chrom, _, _ in regions)
+
+    region_cost = 0
+    for chrom, start, end in regions:
+        density = mapped.get(chrom, 0) / lengths.get(chrom, 1)
+        region_cost += density * (end - start) + SEEK_COST
+    scan_cost = sum(mapped.get(chrom, 0) + SEEK_COST for chrom in chroms)
+
+    if plan == 'auto':
+        plan = 'regions' if region_cost <= scan_cost else 'scan'
+    eprint(' Search plan: {} (estimated cost: {:,.0f} to fetch {:,} regions, {:,.0f} to scan {:,} chromosomes)'
+           .format(plan, region_cost, len(regions), scan_cost, len(chroms)))
+
+    if plan == 'scan':
+        return [(chrom, None, None) for chrom in samfile.references if chrom in chroms]
+    return regions
+
+
+def search_region(samfile, region, intron_index):
+    """Return the number of lines read in a region, and a list of (intron,
+    alignment) pairs for each alignment supporting one of the introns. A region
+    without a start and end covers the whole chromosome.
     """
-    introns = list()
+    line_count = 0
+    matches = []
 
-    cigar_type = [i[0] for i in cigar]
-    cigar_len = [i[1] for i in cigar]
+    chrom, start, end = region
+    for line in profiler.sample('find_supporting_alignments', samfile.fetch(chrom, start, end)):
+        line_count += 1
+        # parse alignment
+        pos = line.pos + 1  # SAM coordinates are 1-based
+        cigar = line.cigartuples
+        # find introns
+        for i_start, i_end in parse_CIGAR(pos, cigar)[0]:
+            for intron in intron_index.match(chrom, i_start, i_end):
+                matches.append((intron, line))
 
-    for i in [i for i, l in enumerate(cigar_type) if l == 3]:
-        size = cigar_len[i]
-        start = pos
-        for j in range(len(cigar_type[:i])):
-            if cigar_type[j] in [0, 2, 3]:
-                start += cigar_len[j]
-        end = start + size - 1
+    return line_count, matches
 
-        introns.append((chrom, start, end))
 
-    return introns
+def init_worker(input_path, parsed_introns, tolerance):
+    """Give each worker process its own file handle and intron index."""
+    global worker_samfile, worker_index
+    profiler.detach()
+    worker_samfile = pysam.AlignmentFile(input_path, optype(input_path, 'r'))
+    worker_index = IntronIndex(parsed_introns, tolerance)
 
 
-def find_supporting_alignments(samfile, parsed_introns):
+def search_region_worker(region):
+    """Worker function: search one region. Alignments can't be pickled, so
+    they are passed back as SAM formatted strings.
+    """
+    line_count, matches = search_region(worker_samfile, region, worker_index)
+    return line_count, [(intron, line.to_string()) for intron, line in matches]
+
+
+def find_supporting_alignments(samfile, parsed_introns, tolerance=0, processes=1, plan='auto', read_span=None):
     """Read though the BAM file and find all introns, as specified in the CIGAR
-    string, with number of supporting reads.
+    string, and yield an (intron, alignment) pair for each supporting alignment.
+    With more than one process, the regions are searched by a pool of workers
+    and the results are merged in region order.
     """
-    alignments_matching = defaultdict(list)
     line_count = 0
     found_count = 0
 
-    for chrom, start, end in regions_to_search(parsed_introns):
-        for line in samfile.fetch(chrom, start, end):
-            line_count += 1
-            progress.update(line_count, found_count)
-            # parse alignment
-            chrom = samfile.get_reference_name(line.reference_id)
-            pos = line.pos + 1  # SAM coordinates are 1-based
-            cigar = line.cigar
-            # find introns
-            for intron in parse_CIGAR(chrom, pos, cigar):
-                if intron in parsed_introns:
-                    found_count += 1
-                    alignments_matching[intron].append(line)
+    if read_span is None:
+        read_span = sample_read_span(samfile)
+        eprint(' Largest read span in a sample of {:,} alignments: {:,}bp'.format(SAMPLE_SIZE, read_span))
+    with metrics.stage('plan regions'):
+        regions = list(regions_to_search(parsed_introns, read_span, tolerance))
+        regions = plan_search(samfile, regions, plan)
+
+    if processes > 1:
+        pool = Pool(processes, initializer=init_worker,
+                    initargs=(samfile.filename.decode(), parsed_introns, tolerance))
+        header = samfile.header
+        results = ((n, [(intron, pysam.AlignedSegment.fromstring(line, header)) for intron, line in matches])
+                   for n, matches in pool.imap(search_region_worker, regions))
+    else:
+        intron_index = IntronIndex(parsed_introns, tolerance)
+        results = (search_region(samfile, region, intron_index) for region in regions)
+
+    for n, matches in results:
+        line_count += n
+        found_count += len(matches)
+        progress.update(line_count, found_count)
+        for intron, line in matches:
+            yield intron, line
+
+    if processes > 1:
+        pool.close()
+        pool.join()
 
+    metrics.count(reads=line_count)
     eprint('\r {:,} lines read. {:,} supporting alignments found!{}'.format(line_count, found_count, ' '*20))
 
-    return alignments_matching
-
 
 def report_all_alignments(samfile, alignments_matching):
     """Report all alignments for reads, and paired-reads, supporting the
-    specified introns
+    specified introns, as (intron, alignment) pairs. For BAM files the
+    alignments are retrieved through a read name index; otherwise the whole
+    file is read.
     """
     reads_supporting = defaultdict(set)
-    alignments_matching_all = defaultdict(set)
     line_count = 0
     found_count = 0
 
     # get the reads that support the intron(s)
-    for intron, lines in alignments_matching.items():
-        for read in [i.qname for i in lines]:
-            reads_supporting[read].add(intron)
+    for intron, line in alignments_matching:
+        reads_supporting[line.qname].add(intron)
+    eprint('Searching for read mates and alternative alignments for supporting reads:')
+
+    qname_index = None
+    if samfile.is_bam:
+        try:
+            qname_index = ReadNameIndex(samfile.filename.decode())
+        except (OSError, sqlite3.Error) as e:
+            eprint(' Could not use a read name index ({}), reading the whole file'.format(e))
+
+    if qname_index is not None:
+        alignments = qname_index.fetch(reads_supporting)
+    else:
+        alignments = samfile.fetch()
 
-    for line in samfile.fetch():
+    for line in alignments:
         line_count += 1
         progress.update(line_count, found_count)
         # parse alignment
@@ -255,48 +690,46 @@ def report_all_alignments(samfile, alignments_matching):
         if read in reads_supporting:
             for intron in reads_supporting[read]:
                 found_count += 1
-                alignments_matching_all[intron].add(line)
+                yield intron, line
 
+    if qname_index is not None:
+        qname_index.close()
+    metrics.count(reads=line_count)
     eprint('\r', ' '*79, end='')
     eprint('\r Reporting {:,} total alignments!'.format(found_count))
 
-    return alignments_matching_all
-
 
 ######################
 # Output the results #
 ######################
-def print_to_individual_files(samfile, parsed_introns, alignments_matching, ext='sam'):
-    for intron in parsed_introns:
-        if intron in alignments_matching:
-            output_path = '_'.join(map(str, intron)) + '.' + ext
-            outfile = pysam.AlignmentFile(output_path, optype(output_path, 'w'), template=samfile)
-            for line in alignments_matching[intron]:
-                 outfile.write(line)
-            outfile.close()
-            eprint(' Wrote {:,} lines to: {}'.format(len(alignments_matching[intron]), output_path))
+def print_to_individual_files(samfile, parsed_introns, matches, ext='sam'):
+    """Stream the alignments supporting each intron into a separate file."""
+    writer = IntronFileWriter(samfile, ext)
+    for intron, line in matches:
+        writer.write(intron, line)
+    with metrics.stage('sort'):
+        writer.close()
+
+    for intron in OrderedDict.fromkeys(parsed_introns):
+        metrics.count(features=writer.count(intron))
+        if writer.count(intron) > 0:
+            eprint(' Wrote {:,} lines to: {}'.format(writer.count(intron), writer.path(intron)))
         else:
             eprint(' Could not find support for intron at {}'.format(format_intron(intron)))
 
 
-def print_all_to_one_file(samfile, parsed_introns, alignments_matching, output_path):
-    alignment_set = set()
-
-    #  output file is either SAM or BAM, depending the output_path extension
-    outfile = pysam.AlignmentFile(output_path, optype(output_path, 'w'), template=samfile)
-
-    # alignments can support more than one intron, so remove duplicate entries
-    for intron, lines in alignments_matching.items():
-        for line in lines:
-            alignment_set.add(line)
-
-    # print the output
-    for line in alignment_set:
-        outfile.write(line)
-
-    eprint(' Wrote {:,} lines to {}'.format(len(alignment_set), output_path))
+def print_all_to_one_file(samfile, matches, output_path):
+    """Stream the supporting alignments into one coordinate-sorted file.
+    Alignments can support more than one intron, so duplicates are removed.
+    """
+    writer = SortedAlignmentWriter(samfile, output_path)
+    for intron, line in matches:
+        writer.write(line)
+    with metrics.stage('sort'):
+        writer.close()
+    metrics.count(features=writer.count)
 
-    outfile.close()
+    eprint(' Wrote {:,} lines to {}'.format(writer.count, output_path))
 
 
 #############
@@ -304,7 +737,9 @@ def print_all_to_one_file(samfile, parsed_introns, alignments_matching, output_p
 #############
 if __name__ == '__main__':
     # parse commandline arguments
-    parsed_introns, input_path, report_all, output_path, quiet = parse_commandline_arguments()
+    with metrics.stage('parse inputs'):
+        parsed_introns, input_path, report_all, output_path, bam_output, quiet, tolerance, processes, plan, read_span, metrics.path, profile_dir = parse_commandline_arguments()
+    profiler.start(profile_dir)
     samfile = pysam.AlignmentFile(input_path, optype(input_path, 'r'))
     eprint('{:,} intron{} to search for.'.format(len(parsed_introns), ['s' if len(parsed_introns) != 1 else ''][0]))
 
@@ -312,19 +747,20 @@ if __name__ == '__main__':
     num_lines = count_lines(input_path)
     progress = Progress(num_lines)
 
-    # find supporting alignments
+    # find supporting alignments; these are streamed to the output as they're found
     eprint('Searching for supporting alignments:')
-    alignments_matching = find_supporting_alignments(samfile, parsed_introns)
+    alignments_matching = find_supporting_alignments(samfile, parsed_introns, tolerance, processes, plan, read_span)
     if report_all:
-        eprint('Searching for read mates and alternative alignments for supporting reads:')
         alignments_matching = report_all_alignments(samfile, alignments_matching)
 
     # output the results
-    eprint('Writing output:')
-    if output_path is not None:
-        print_all_to_one_file(samfile, parsed_introns, alignments_matching, output_path)
-    else:
-        print_to_individual_files(samfile, parsed_introns, alignments_matching)
+    with metrics.stage('scan BAM and write'):
+        if output_path is not None:
+            print_all_to_one_file(samfile, alignments_matching, output_path)
+        else:
+            print_to_individual_files(samfile, parsed_introns, alignments_matching, 'bam' if bam_output else 'sam')
 
     samfile.close()
+    profiler.stop()
+    metrics.write()
     eprint('Done! (runtime = {}min)'.format('%.2f' % progress.elapsed()))
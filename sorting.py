@@ -0,0 +1,63 @@
+# Purpose: Shared external sorting for the alignment scripts. Alignments are
+#          written to temporary BAM files in sorted runs, which are merged a
+#          limited number at a time, so only a bounded number of alignments
+#          and open files are held at once.
+
+from __future__ import print_function
+import heapq, os, tempfile
+import pysam
+
+MERGE_FILES = 64 # maximum number of sorted runs merged at once
+
+def sort_key(line):
+    """Sort by reference, then position, with unmapped reads last."""
+    return line.reference_id < 0, line.reference_id, line.pos
+
+
+def new_run(output_path, header, threads=1):
+    """Create a temporary BAM file for a sorted run next to 'output_path'.
+    Returns its path and the open file.
+    """
+    fd, run_path = tempfile.mkstemp(suffix='.bam', dir=os.path.dirname(os.path.abspath(output_path)))
+    os.close(fd)
+    return run_path, pysam.AlignmentFile(run_path, 'wb', header=header, threads=threads)
+
+
+def merge_runs(run_paths, lines=()):
+    """Yield the alignments of sorted runs (and of a sorted list of alignments)
+    in order. The runs are all open at once, so give at most MERGE_FILES.
+    """
+    runs = []
+    try:
+        for run_path in run_paths:
+            runs.append(pysam.AlignmentFile(run_path, 'rb', check_sq=False))
+        for line in heapq.merge(lines, *[i.fetch(until_eof=True) for i in runs], key=sort_key):
+            yield line
+    finally:
+        for run in runs:
+            run.close()
+
+
+def reduce_runs(run_paths, output_path, header, threads=1):
+    """Merge the oldest MERGE_FILES runs into a new run until at most
+    MERGE_FILES are left. 'run_paths' is updated in place, so it always holds
+    every run still on disk.
+    """
+    while len(run_paths) > MERGE_FILES:
+        batch = run_paths[:MERGE_FILES]
+        run_path, outfile = new_run(output_path, header, threads)
+        run_paths.append(run_path)
+        with outfile:
+            for line in merge_runs(batch):
+                outfile.write(line)
+        for path in batch:
+            os.remove(path)
+        del run_paths[:MERGE_FILES]
+
+
+def remove_runs(run_paths):
+    """Remove any runs still on disk and empty 'run_paths'."""
+    for run_path in run_paths:
+        if os.path.exists(run_path):
+            os.remove(run_path)
+    del run_paths[:]
@@ -3,7 +3,53 @@
 # Author: Matt Douglas
 
 from __future__ import print_function
-import os, pysam, sys
+import argparse, copy, heapq, os, pysam, sys, tempfile
+from multiprocessing import Pool
+from cigar import parse_CIGAR
+from sorting import MERGE_FILES, merge_runs, new_run, reduce_runs, remove_runs, sort_key
+from metrics import Metrics
+from profiling import Profiler
+
+BUFFER_SIZE = 1000000 # maximum number of split alignments waiting to be sorted
+
+metrics = Metrics() # timings and counts for each stage, written with --metrics
+profiler = Profiler() # CPU, memory and per-read profiles, written with --profile
+
+def parse_commandline_arguments():
+    parser = argparse.ArgumentParser(description='Split spliced alignments into one alignment per exon block.')
+    parser.add_argument('input',
+                        type=str,
+                        help='input SAM/BAM file')
+    parser.add_argument('output',
+                        type=str,
+                        help='output SAM/BAM file')
+    parser.add_argument('-t',
+                        '--threads',
+                        type=int,
+                        default=1,
+                        help='number of threads used to compress and decompress BAM files (default=1)')
+    parser.add_argument('-b',
+                        '--buffer-size',
+                        type=int,
+                        default=BUFFER_SIZE,
+                        help='maximum number of alignments held in memory while sorting (default={})'.format(BUFFER_SIZE))
+    parser.add_argument('-p',
+                        '--processes',
+                        type=int,
+                        default=1,
+                        help='number of worker processes, each splitting one chromosome of an indexed BAM file (default=1)')
+    parser.add_argument('--metrics',
+                        type=str,
+                        metavar='FILE',
+                        help='write the time, reads decoded, alignments written and peak memory of each stage to FILE as JSON')
+    parser.add_argument('--profile',
+                        type=str,
+                        metavar='DIR',
+                        help='profile the main process and write a CPU profile, the top memory allocations and a sampled time-per-read histogram to DIR')
+    args = parser.parse_args()
+
+    return args.input, args.output, args.threads, args.buffer_size, args.processes, args.metrics, args.profile
+
 
 def eprint(*args, **kwargs):
     """Print to stderr."""
@@ -18,77 +64,287 @@ def optype(path, op='r'):
     return op
 
 
-def parse_CIGAR(cigar):
-    """Parse a pysam formatted CIGAR string return positions of each skip."""
-    ref_pos = 0
-    str_pos = 0
-    ref_pos_list = [0]
-    str_pos_list = [0]
-    cigar_list = []
-
-    cigar_type = [i[0] for i in cigar]
-    cigar_len  = [i[1] for i in cigar]
-
-    prev = []
-    for n, i in enumerate(cigar_type):
-        j = cigar_len[n]
-        if i == 0: # match
-            ref_pos += j
-            str_pos += j
-            prev.append((i, j))
-        elif i == 1: # insertion
-            str_pos += j
-            prev.append((i, j))
-        elif i == 2: # deletion
-            ref_pos += j
-            prev.append((i, j))
-        elif i == 3: # skip
-            ref_pos += j
-            ref_pos_list.append(ref_pos)
-            str_pos_list.append(str_pos)
-            cigar_list.append(prev)
-            prev = []
-        elif i == 4: # soft clipping
-            str_pos += j
-            prev.append((i, j))
-    ref_pos_list.append(ref_pos)
-    str_pos_list.append(str_pos)
-    cigar_list.append(prev)
-
-    return ref_pos_list, str_pos_list, cigar_list
+def split_alignment(line):
+    """Return a list with one alignment for each exon block of an alignment."""
+    pos = line.pos # SAM coordinates are 1-based
+    seq = line.query_sequence
+    qual = line.query_qualities
+    cigar = line.cigartuples
+    _, blocks, query_slices, block_cigars = parse_CIGAR(pos, cigar)
+    if len(blocks) < 2:
+        line.template_length = 0
+        return [line]
+
+    new_lines = []
+    for (new_pos, _), (qstart, qend), new_cigar in zip(blocks, query_slices, block_cigars):
+        # create a new line for each block, rather than reusing the input
+        new_line = copy.copy(line)
+        new_line.pos = new_pos
+        if seq is not None:
+            new_line.query_sequence = seq[qstart:qend]
+        if qual is not None:
+            new_line.query_qualities = qual[qstart:qend]
+        new_line.cigar = new_cigar
+        new_line.template_length = 0
+        new_lines.append(new_line)
+
+    return new_lines
 
 
 def split_alignments(infile):
-    for line in infile.fetch():
-        pos = line.pos # SAM coordinates are 1-based
-        seq = line.query_sequence
-        qual = line.query_qualities
-        cigar = line.cigar
-        ref_pos_list, str_pos_list, cigar_list = parse_CIGAR(cigar)
-        for i in range(len(str_pos_list) - 1):
-            new_pos = pos + ref_pos_list[i]
-            new_seq = seq[str_pos_list[i] : str_pos_list[i + 1]]
-            if qual is not None:
-                new_qual = qual[str_pos_list[i] : str_pos_list[i + 1]]
-            else:
-                new_qual = None
-            # create the new line(s)
-            new_line = line
-            new_line.pos = new_pos
-            new_line.query_sequence = new_seq
-            new_line.query_qualities = new_qual
-            new_line.cigar = cigar_list[i]
-            new_line.template_length = 0
+    for line in profiler.sample('split_alignments', infile.fetch(until_eof=True)):
+        for new_line in split_alignment(line):
             yield new_line
 
 
+class SortedWriter(object):
+    """Write split alignments in coordinate order. Every block of an alignment
+    starts at or after the alignment itself, so when the input is sorted, a
+    split alignment can be written once the input has moved past its position;
+    until then it waits in a heap, which only spans about one intron.
+
+    If the input isn't coordinate-sorted (or the heap grows past
+    'buffer_size'), the writer falls back to an external sort: alignments are
+    collected in a buffer of at most 'buffer_size' alignments, which is sorted
+    and written to a temporary run whenever it fills up. Runs are merged, at
+    most MERGE_FILES at a time, when the writer is closed, and BAM output is
+    indexed.
+
+    Attributes:
+        output_path: The path of the output file.
+        header: The header of the output file.
+        threads: Number of threads used to compress BAM files.
+        buffer_size: Maximum number of alignments held in memory.
+        presorted: Whether the input is still coordinate-sorted (False once
+                   the writer has fallen back to an external sort).
+        heap: Alignments waiting to be written, as (key, number, alignment).
+        buffer: Alignments waiting to be sorted, after falling back.
+        runs: Paths of the sorted runs written so far.
+        outfile: The run being written from the heap.
+        last_key: The key of the last alignment written from the heap.
+        input_key: The key of the last input alignment.
+        count: The number of alignments added.
+        index: Whether to index BAM output.
+    """
+
+    def __init__(self, output_path, header, threads=1, buffer_size=BUFFER_SIZE, index=True, presorted=True):
+        self.output_path = output_path
+        self.header = header
+        self.threads = threads
+        self.buffer_size = buffer_size
+        self.index = index
+        self.presorted = presorted
+        self.heap = []
+        self.buffer = []
+        self.runs = []
+        self.outfile = None
+        self.last_key = None
+        self.input_key = None
+        self.count = 0
+
+    def advance(self, key):
+        """Write every alignment sorting before 'key' (the key of the next
+        input alignment); nothing added later may sort before it.
+        """
+        if not self.presorted:
+            return
+        if self.input_key is not None and key < self.input_key:
+            eprint('Input is not coordinate-sorted, sorting through temporary files')
+            self.fall_back()
+            return
+        self.input_key = key
+        while len(self.heap) > 0 and self.heap[0][0] < key:
+            self.emit(heapq.heappop(self.heap))
+
+    def write(self, line):
+        self.count += 1
+        if not self.presorted:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.buffer_size:
+                self.spill()
+            return
+        heapq.heappush(self.heap, (sort_key(line), self.count, line))
+        if len(self.heap) > self.buffer_size:
+            self.emit(heapq.heappop(self.heap))
+
+    def emit(self, item):
+        key, _, line = item
+        if self.outfile is not None and key < self.last_key:
+            # the heap was too small to put the output in order
+            heapq.heappush(self.heap, item)
+            self.fall_back()
+            return
+        if self.outfile is None:
+            self.outfile = self.new_run()
+        self.outfile.write(line)
+        self.last_key = key
+
+    def fall_back(self):
+        """Stop writing from the heap and sort the rest of the alignments
+        through temporary runs.
+        """
+        self.presorted = False
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+        self.buffer = [line for _, _, line in sorted(self.heap)]
+        self.heap = []
+        if len(self.buffer) >= self.buffer_size:
+            self.spill()
+
+    def new_run(self):
+        """Return a new temporary file for a sorted run."""
+        run_path, outfile = new_run(self.output_path, self.header, self.threads)
+        self.runs.append(run_path)
+        return outfile
+
+    def spill(self):
+        """Sort the buffer and write it to a new run."""
+        with self.new_run() as outfile:
+            for line in sorted(self.buffer, key=sort_key):
+                outfile.write(line)
+        self.buffer = []
+
+    def close(self):
+        """Write the remaining alignments and merge the runs into the output."""
+        try:
+            while len(self.heap) > 0:
+                self.emit(heapq.heappop(self.heap))
+            if self.outfile is not None:
+                self.outfile.close()
+                self.outfile = None
+            lines = sorted(self.buffer, key=sort_key)
+            self.buffer = []
+
+            # merge in batches, so only MERGE_FILES runs are open at once
+            if len(self.runs) > MERGE_FILES:
+                eprint('Merging {:,} sorted runs...'.format(len(self.runs)))
+            reduce_runs(self.runs, self.output_path, self.header, self.threads)
+
+            if len(self.runs) == 1 and len(lines) == 0 and optype(self.output_path) == 'rb':
+                # mkstemp() makes the run private; give it the usual permissions
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(self.runs[0], 0o666 & ~umask)
+                os.replace(self.runs.pop(), self.output_path)
+            else:
+                with pysam.AlignmentFile(self.output_path, optype(self.output_path, 'w'), header=self.header, threads=self.threads) as outfile:
+                    for line in merge_runs(self.runs, lines):
+                        outfile.write(line)
+        finally:
+            self.remove_runs()
+
+        if self.index and optype(self.output_path) == 'rb':
+            pysam.index(self.output_path)
+
+    def remove_runs(self):
+        """Close and remove any temporary runs."""
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+        remove_runs(self.runs)
+
+
+def split_to_sorted_file(infile, writer, contig=None):
+    """Split the alignments on one contig ('*' for unplaced reads), or in the
+    whole file, into a SortedWriter.
+    """
+    if contig is None:
+        alignments = infile.fetch(until_eof=True)
+    else:
+        alignments = infile.fetch(contig)
+
+    reads = 0
+    try:
+        for line in profiler.sample('split_alignments', alignments):
+            reads += 1
+            writer.advance(sort_key(line))
+            for new_line in split_alignment(line):
+                writer.write(new_line)
+        writer.close()
+    finally:
+        writer.remove_runs()
+    metrics.count(reads=reads, features=writer.count)
+
+
+def split_contig(task):
+    """Worker function: split the alignments on one contig into a temporary
+    BAM file. Returns the number of reads decoded and alignments written.
+    """
+    input_path, contig, part_path, header, buffer_size = task
+    with pysam.AlignmentFile(input_path, optype(input_path, 'r')) as infile, metrics.stage('split contig') as stage:
+        writer = SortedWriter(part_path, header, 1, buffer_size, index=False)
+        split_to_sorted_file(infile, writer, contig)
+
+    return stage['reads'], stage['features']
+
+
+def split_parallel(infile, input_path, output_path, header, threads, buffer_size, processes):
+    """Split each contig in a separate process, then concatenate the sorted
+    parts in header order. The largest contigs are started first.
+    """
+    mapped = {i.contig:i.mapped + i.unmapped for i in infile.get_index_statistics()}
+    contigs = [i for i in infile.references if mapped.get(i, 0) > 0] + ['*']
+    out_dir = os.path.dirname(os.path.abspath(output_path))
+    tasks = []
+    for contig in contigs:
+        fd, part_path = tempfile.mkstemp(suffix='.bam', dir=out_dir)
+        os.close(fd)
+        tasks.append((input_path, contig, part_path, header, buffer_size))
+    parts = [i[2] for i in tasks]
+
+    pool = Pool(processes, initializer=profiler.detach)
+    try:
+        with metrics.stage('split and sort'):
+            for reads, features in pool.imap_unordered(split_contig, sorted(tasks, key=lambda x: -mapped.get(x[1], 0))):
+                metrics.count(reads=reads, features=features)
+    finally:
+        pool.close()
+        pool.join()
+
+    with metrics.stage('concatenate'):
+        concatenate_parts(parts, output_path, header)
+
+
+def concatenate_parts(parts, output_path, header):
+    """Concatenate the sorted parts into the output and remove them."""
+    if optype(output_path) == 'rb':
+        pysam.cat('--no-PG', '-o', output_path, *parts)
+        pysam.index(output_path)
+    else:
+        with pysam.AlignmentFile(output_path, 'w', header=header) as outfile:
+            for part_path in parts:
+                with pysam.AlignmentFile(part_path, 'rb', check_sq=False) as part:
+                    for line in part.fetch(until_eof=True):
+                        outfile.write(line)
+    for part_path in parts:
+        os.remove(part_path)
+
+
+def sorted_header(infile):
+    """Return the header of the input, marked as coordinate-sorted."""
+    header = infile.header.to_dict()
+    header.setdefault('HD', {'VN': '1.6'})['SO'] = 'coordinate'
+    return header
+
+
 if __name__ == '__main__':
-    if len(sys.argv) < 3:
-        print('USAGE: split_alignments.py input.bam output.bam')
-        sys.exit(1)
+    input_path, output_path, threads, buffer_size, processes, metrics.path, profile_dir = parse_commandline_arguments()
+    profiler.start(profile_dir)
+
+    infile = pysam.AlignmentFile(input_path, optype(input_path, 'r'), check_sq=False, threads=threads)
+    header = sorted_header(infile)
 
-    infile = pysam.AlignmentFile(sys.argv[1], optype(sys.argv[1], 'r'), check_sq=False)
-    outfile = pysam.AlignmentFile(sys.argv[2], optype(sys.argv[2], 'w'), template=infile)
+    if processes > 1 and infile.has_index():
+        split_parallel(infile, input_path, output_path, header, threads, buffer_size, processes)
+    else:
+        if processes > 1:
+            eprint('Input is not indexed, splitting alignments in serial')
+        presorted = infile.header.to_dict().get('HD', {}).get('SO') not in ('queryname', 'unsorted')
+        writer = SortedWriter(output_path, header, threads, buffer_size, presorted=presorted)
+        with metrics.stage('split and sort'):
+            split_to_sorted_file(infile, writer)
 
-    for line in split_alignments(infile):
-        outfile.write(line)
+    infile.close()
+    profiler.stop()
+    metrics.write()